@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+""" TTL Cache class.
+    - A thread safe, in process, least recently used cache with a time to
+      live on each entry, and hit / miss counters.
+"""
+
+import threading, time
+from collections import OrderedDict
+
+from typing import Any, Dict
+
+
+class TTLCache:
+
+    # For logging
+    name: str = 'cloud_common.cc.cache'
+
+
+    #--------------------------------------------------------------------------
+    # max_size: the maximum number of entries, the least recently used entry
+    #           is evicted when full.
+    # ttl_seconds: how long an entry is valid for, None for forever.
+    def __init__(self, max_size: int = 500, ttl_seconds: Any = 10) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.__entries = OrderedDict() # key: (expires, value)
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    #--------------------------------------------------------------------------
+    # Returns the cached value, or default if not found or expired.
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or time.monotonic() < expires:
+                    self.__entries.move_to_end(key) # most recently used
+                    self.hits += 1
+                    return value
+                del self.__entries[key] # expired
+            self.misses += 1
+            return default
+
+
+    #--------------------------------------------------------------------------
+    # Add or replace a value.
+    def put(self, key: Any, value: Any) -> None:
+        expires = None
+        if self.ttl_seconds is not None:
+            expires = time.monotonic() + self.ttl_seconds
+        with self.__lock:
+            self.__entries[key] = (expires, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False) # least recently used
+                self.evictions += 1
+
+
+    #--------------------------------------------------------------------------
+    # Remove a value (if it is cached).
+    def invalidate(self, key: Any) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+
+    #--------------------------------------------------------------------------
+    # Remove all values.
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+
+    #--------------------------------------------------------------------------
+    # Returns a dict of the cache counters.
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {'size': len(self.__entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
@@ -3,15 +3,40 @@
 # BigQuery is SLOW.  Only use it for research queries and warn the user.
 # Note: most data from the device is cached in the datastore.
 
-import ast, logging
-from google.cloud import bigquery
+import ast, logging, threading
 
+from typing import Any, List
+
+from cloud_common.cc import utils
+from cloud_common.cc.google import clients
 from cloud_common.cc.google import env_vars
 
 # This should be the only place we store queries.
 from cloud_common.cc.google import queries
 
-bigquery_client = bigquery.Client()
+# Loaded on first use, it is slow to import.
+bigquery = utils.lazy_import('google.cloud.bigquery')
+
+# Globals
+__table = None # our env. var. table (with its schema), fetched once
+__table_lock = threading.Lock()
+
+
+#------------------------------------------------------------------------------
+# Returns the shared (per process) bigquery client.
+def get_client() -> Any:
+    return clients.get_client(clients.BIGQUERY)
+
+
+#------------------------------------------------------------------------------
+# The old bigquery_client module global, now made on first use.
+def __getattr__(name: str) -> Any:
+    if 'bigquery_client' == name:
+        return get_client()
+    raise AttributeError(f'module {__name__} has no attribute {name}')
+
+
+clients.register(clients.BIGQUERY, lambda: bigquery.Client())
 
 
 # ------------------------------------------------------------------------------
@@ -31,7 +56,7 @@ def get_temp_and_humidity_history_from_BQ(device_uuid):
     job_config.use_legacy_sql = False
     query_str = queries.formatQuery(
         queries.fetch_temp_results_history, device_uuid)
-    query_job = bigquery_client.query(query_str, job_config=job_config)
+    query_job = get_client().query(query_str, job_config=job_config)
     query_result = query_job.result()
     for row in list(query_result):
         rvalues = row[2]  # can't use row.values
@@ -50,23 +75,55 @@ def get_temp_and_humidity_history_from_BQ(device_uuid):
 
 
 #------------------------------------------------------------------------------
-# Insert data into our bigquery dataset and table.
-def data_insert(rowsList):
-    try:
-        logging.info( "bq insert rows: {}".format(rowsList))
+# Returns our bigquery table (with its schema), which is only fetched the
+# first time.  insert_rows() needs the schema to convert the rows.
+def get_table() -> Any:
+    global __table
+    table = __table # fast path, no lock
+    if table is not None:
+        return table
+    with __table_lock:
+        if __table is None:
+            client = get_client()
+            dataset_ref = client.dataset( env_vars.bq_dataset, 
+                    project=env_vars.cloud_project_id )
+            table_ref = dataset_ref.table( env_vars.bq_table )
+            __table = client.get_table( table_ref )               
+        return __table
 
-        dataset_ref = bigquery_client.dataset( env_vars.bq_dataset, 
-                project=env_vars.cloud_project_id )
-        table_ref = dataset_ref.table( env_vars.bq_table )
-        table = bigquery_client.get_table( table_ref )               
 
-        response = bigquery_client.insert_rows( table, rowsList)
-        logging.debug( 'bq response: {}'.format( response ))
+#------------------------------------------------------------------------------
+# Forget the cached table, it is fetched again on next use.
+def clear_table_cache() -> None:
+    global __table
+    with __table_lock:
+        __table = None
+
 
-        return True
+#------------------------------------------------------------------------------
+# Insert rows into our bigquery table.
+# Returns the list of rows that failed (empty if they were all inserted).
+# If the whole insert failed, all the rows are returned.
+def insert_rows(rowsList: List) -> List:
+    if 0 == len(rowsList):
+        return []
+    try:
+        errors = get_client().insert_rows( get_table(), rowsList )
+        if not errors:
+            return []
+        logging.error(f'bigquery.insert_rows: {len(errors)} of '
+                f'{len(rowsList)} rows failed: {errors}')
+        # each error is a mapping with the index of the failed row
+        return [rowsList[e['index']] for e in errors]
 
     except Exception as e:
-        logging.critical( "bigquery.data_insert: Exception: %s" % e )
-        return False
+        logging.critical( "bigquery.insert_rows: Exception: %s" % e )
+        clear_table_cache() # in case it was changed or deleted
+        return list(rowsList)
 
 
+#------------------------------------------------------------------------------
+# Insert data into our bigquery dataset and table.
+def data_insert(rowsList):
+    logging.info( "bq insert rows: {}".format(rowsList))
+    return 0 == len(insert_rows(rowsList))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+""" BigQuery Row Buffer class.
+    - Opt in, shared buffer in front of bigquery.insert_rows().
+    - Rows from all callers (threads) are collected and streamed into BQ in
+      one insert, when the buffer has max_rows rows, or max_bytes bytes, or
+      its oldest row is max_age_seconds old.  Anything left is inserted
+      when the process exits (or call flush(), or close() when done with
+      the buffer).
+    - push() never inserts on the caller's thread, full batches are
+      inserted by a background thread, one at a time.
+    - Only the rows BQ reports as failed are retried, with backoff, up to
+      max_attempts times, then they are logged and dropped.
+"""
+
+import atexit, logging, threading, time
+from concurrent import futures
+
+from typing import Any, Dict, List
+
+from cloud_common.cc.google import bigquery
+from cloud_common.cc.google.retry import RetryPolicy
+
+
+class BigQueryRowBuffer:
+
+    # For logging
+    name: str = 'cloud_common.cc.google.bigquery_row_buffer'
+
+
+    #--------------------------------------------------------------------------
+    # max_rows: insert when this many rows are buffered (BQ suggests 500).
+    # max_bytes: insert when the rows are about this big.
+    # max_age_seconds: the longest a row waits in the buffer.
+    # max_attempts: inserts of a failed row before it is dropped.
+    def __init__(self, max_rows: int = 500, max_bytes: int = 1000000,
+            max_age_seconds: float = 5.0, max_attempts: int = 3) -> None:
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.max_attempts = max_attempts
+        self.retry_policy = RetryPolicy(initial_delay=0.2, max_delay=2.0)
+        self.__rows = []
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        self.__timer = None
+        self.__executor = futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='bq-row-buffer')
+        self.__last_insert = None # future of the last background insert
+        self.__closed = False
+        self.__stats = {'pushed': 0, 'inserts': 0, 'inserted': 0,
+                'retried': 0, 'dropped': 0}
+        atexit.register(self.close)
+
+
+    #--------------------------------------------------------------------------
+    # Buffer rows (tuples that match the table schema) to insert.
+    # (after close() they are inserted now, on the caller's thread)
+    def push(self, rowsList: List) -> None:
+        if 0 == len(rowsList):
+            return
+        with self.__lock:
+            self.__stats['pushed'] += len(rowsList)
+            if not self.__closed:
+                self.__rows.extend(rowsList)
+                self.__bytes += sum([self.__row_size(row) 
+                    for row in rowsList])
+                if len(self.__rows) >= self.max_rows or \
+                        self.__bytes >= self.max_bytes:
+                    # enough for an insert, so start it now (submitted under
+                    # the lock, so __last_insert is the last one submitted)
+                    self.__last_insert = self.__executor.submit(
+                            self.__insert, self.__take_rows())
+                elif self.__timer is None:
+                    self.__timer = threading.Timer(self.max_age_seconds,
+                            self.flush)
+                    self.__timer.daemon = True
+                    self.__timer.start()
+                return
+        self.__insert(list(rowsList))
+
+
+    #--------------------------------------------------------------------------
+    # Insert everything that is buffered, on this thread, and wait for any
+    # background insert already started.  (the executor is shut down before
+    # atexit functions run, so this can't use it)
+    # Returns the number of rows inserted by this flush.
+    def flush(self) -> int:
+        with self.__lock:
+            rows = self.__take_rows()
+            last_insert = self.__last_insert
+        if last_insert is not None:
+            last_insert.result()
+        return self.__insert(rows)
+
+
+    #--------------------------------------------------------------------------
+    # Insert everything that is buffered and stop the background thread.
+    # Called when the process exits, if not before.
+    def close(self) -> None:
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+        atexit.unregister(self.close)
+        self.flush()
+        self.__executor.shutdown(wait=True)
+
+
+    #--------------------------------------------------------------------------
+    # Returns a dict of counters: pushed rows, inserts (BQ calls), inserted
+    # rows, retried rows and dropped rows.
+    def get_stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__stats)
+
+
+    #--------------------------------------------------------------------------
+    # Private: take all the buffered rows and stop the timer.
+    # Call with the lock held.
+    def __take_rows(self) -> List:
+        rows = self.__rows
+        self.__rows = []
+        self.__bytes = 0
+        if self.__timer is not None:
+            self.__timer.cancel() # harmless if we are the timer thread
+            self.__timer = None
+        return rows
+
+
+    #--------------------------------------------------------------------------
+    # Private: insert rows, retrying only the ones that failed.
+    # Returns the number of rows inserted.
+    def __insert(self, rows: List) -> int:
+        if 0 == len(rows):
+            return 0
+        inserted = 0
+        attempt = 0
+        while True:
+            failed = bigquery.insert_rows(rows)
+            attempt += 1
+            with self.__lock:
+                self.__stats['inserts'] += 1
+                self.__stats['inserted'] += len(rows) - len(failed)
+            inserted += len(rows) - len(failed)
+            if 0 == len(failed):
+                return inserted
+            if attempt >= self.max_attempts:
+                logging.error(f'{self.name}: dropped {len(failed)} rows '
+                        f'after {attempt} attempts')
+                with self.__lock:
+                    self.__stats['dropped'] += len(failed)
+                return inserted
+            with self.__lock:
+                self.__stats['retried'] += len(failed)
+            time.sleep(self.retry_policy.get_delay(attempt - 1))
+            rows = failed
+
+
+    #--------------------------------------------------------------------------
+    # Private: about how many bytes a row is when streamed.
+    @staticmethod
+    def __row_size(row: Any) -> int:
+        return sum([len(str(value)) for value in row])
+
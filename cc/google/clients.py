@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+""" Google Cloud Client Registry.
+    - The one place our google cloud clients (datastore, storage, bigquery,
+      IoT, firestore, pubsub) are created.  Each module registers a factory
+      for its client, and the client is created once, under a lock, on first
+      use, then shared by all threads.
+    - gRPC channels are not fork safe, so clients created before an
+      os.fork() are dropped in the child process and created again there
+      on first use.
+    - Counts how many times each client is created, so we can catch
+      regressions (a client should be created once per process).
+"""
+
+import logging, os, threading
+
+from typing import Any, Callable, Dict
+
+
+# Client names
+DATASTORE = 'datastore'
+STORAGE = 'storage'
+BIGQUERY = 'bigquery'
+IOT = 'iot'
+FIRESTORE = 'firestore'
+PUBSUB_SUBSCRIBER = 'pubsub_subscriber'
+PUBSUB_PUBLISHER = 'pubsub_publisher'
+
+# Globals
+__lock = threading.RLock() # reentrant, a factory may get another client
+__factories = {} # client name: function with no args that creates the client
+__clients = {} # client name: client
+__creation_counts = {} # client name: number of times created
+__pid = os.getpid() # the process the clients were created in
+__have_fork_hook = hasattr(os, 'register_at_fork') # python 3.7+
+
+
+#------------------------------------------------------------------------------
+# Register the function that creates a client.
+# Registering a name again replaces its factory (and drops its client).
+def register(name: str, factory: Callable) -> None:
+    with __lock:
+        __factories[name] = factory
+        __clients.pop(name, None)
+
+
+#------------------------------------------------------------------------------
+# Returns the shared client, creating it if needed, or None for error.
+def get_client(name: str) -> Any:
+    __check_pid()
+    client = __clients.get(name) # fast path, no lock
+    if client is not None:
+        return client
+    with __lock:
+        client = __clients.get(name)
+        if client is not None:
+            return client # another thread created it
+        factory = __factories.get(name)
+        if factory is None:
+            logging.error(f'cloud_common.cc.google.clients: no factory '
+                    f'registered for client {name}')
+            return None
+        client = factory()
+        __clients[name] = client
+        __creation_counts[name] = __creation_counts.get(name, 0) + 1
+        logging.debug(f'cloud_common.cc.google.clients: {name} client '
+                f'created in pid {os.getpid()}, '
+                f'count={__creation_counts[name]}')
+        return client
+
+
+#------------------------------------------------------------------------------
+# Use this client instead of creating one (e.g. for a test or local emulator).
+def set_client(name: str, client: Any) -> None:
+    with __lock:
+        __clients[name] = client
+
+
+#------------------------------------------------------------------------------
+# Drop all the clients, they are created again on next use.
+def clear() -> None:
+    with __lock:
+        __clients.clear()
+
+
+#------------------------------------------------------------------------------
+# Returns a dict of client name: number of times it was created.
+def get_creation_counts() -> Dict[str, int]:
+    with __lock:
+        return dict(__creation_counts)
+
+
+#------------------------------------------------------------------------------
+# Private: called in a forked child process, drop the parent's clients (and
+# lock, which another parent thread may have held when we forked).
+def __after_fork_in_child() -> None:
+    global __lock, __pid
+    __lock = threading.RLock()
+    __pid = os.getpid()
+    __clients.clear()
+
+
+#------------------------------------------------------------------------------
+# Private: for pythons without os.register_at_fork(), notice that we are in
+# a forked process because our pid changed.
+def __check_pid() -> None:
+    if not __have_fork_hook and __pid != os.getpid():
+        __after_fork_in_child()
+
+
+if __have_fork_hook:
+    os.register_at_fork(after_in_child=__after_fork_in_child)
@@ -1,11 +1,12 @@
 # All common database code.  From BigQuery and Datastore.
 
-from queries import queries
+from cloud_common.cc.google import queries
 
 from cloud_common.cc import utils 
 from cloud_common.cc.google import env_vars 
 from cloud_common.cc.google import datastore
 from cloud_common.cc.google import bigquery
+from cloud_common.cc.google import device_data_codec
 
 # NOTE: The XX_from_BQ() methods are only used if there is no data found
 # in the Datastore.   
@@ -19,17 +20,14 @@ def get_co2_history(device_uuid):
         return []
 
     # First, try to get the data from the datastore...
-    device_data = get_by_key_from_DS(DS_device_data_KEY, device_uuid)
-    if device_data is None or DS_co2_KEY not in device_data:
+    device_data = datastore.get_cached_device_data_from_DS(device_uuid)
+    if device_data is None or datastore.DS_co2_KEY not in device_data:
         # If we didn't find any data in the DS, look in BQ...
         return get_co2_history_from_BQ(device_uuid)
 
     # process the vars list from the DS into the same format as BQ
     results = []
-    valuesList = device_data[DS_co2_KEY]
-    for val in valuesList:
-        ts = utils.bytes_to_string(val['timestamp'])
-        value = utils.bytes_to_string(val['value'])
+    for ts, value in __iter_history_from_DS(device_data, datastore.DS_co2_KEY):
         results.append({'value': value, 'time': ts})
     return results
 
@@ -43,16 +41,15 @@ def get_led_panel_history(device_uuid):
         return []
 
     # First, try to get the data from the datastore...
-    device_data = get_by_key_from_DS(DS_device_data_KEY, device_uuid)
-    if device_data is None or DS_led_KEY not in device_data:
+    device_data = datastore.get_cached_device_data_from_DS(device_uuid)
+    if device_data is None or datastore.DS_led_KEY not in device_data:
         # If we didn't find any data in the DS, look in BQ...
         return get_led_panel_history_from_BQ(device_uuid)
 
     # process the vars list from the DS into the same format as BQ
     results = []
-    valuesList = device_data[DS_led_KEY]
-    for val in valuesList:
-        led_json = utils.bytes_to_string(val['value'])
+    for ts, led_json in __iter_history_from_DS(device_data, 
+            datastore.DS_led_KEY):
         results.append(led_json)
     return results
 
@@ -71,49 +68,64 @@ def get_temp_and_humidity_history(device_uuid):
         return result_json
 
         # First, try to get the data from the datastore...
-    device_data = get_by_key_from_DS(DS_device_data_KEY, device_uuid)
+    device_data = datastore.get_cached_device_data_from_DS(device_uuid)
     if device_data is None or \
-            (DS_temp_KEY not in device_data and \
-                         DS_rh_KEY not in device_data):
+            (datastore.DS_temp_KEY not in device_data and \
+                         datastore.DS_rh_KEY not in device_data):
         # If we didn't find any data in the DS, look in BQ...
         return get_temp_and_humidity_history_from_BQ(device_uuid)
 
     # process the vars list from the DS into the same format as BQ
 
     # Get temp values
-    if DS_temp_KEY in device_data:
-        valuesList = device_data[DS_temp_KEY]
-        for val in valuesList:
-            ts = utils.bytes_to_string(val['timestamp'])
-            value = utils.bytes_to_string(val['value'])
+    if datastore.DS_temp_KEY in device_data:
+        for ts, value in __iter_history_from_DS(device_data, 
+                datastore.DS_temp_KEY):
             result_json["temp"].append({'value': value, 'time': ts})
 
     # Get RH values
-    if DS_rh_KEY in device_data:
-        valuesList = device_data[DS_rh_KEY]
-        for val in valuesList:
-            ts = utils.bytes_to_string(val['timestamp'])
-            value = utils.bytes_to_string(val['value'])
+    if datastore.DS_rh_KEY in device_data:
+        for ts, value in __iter_history_from_DS(device_data, 
+                datastore.DS_rh_KEY):
             result_json["RH"].append({'value': value, 'time': ts})
 
     return result_json
 
 
+# ------------------------------------------------------------------------------
+# Private: generator of the (timestamp, value) strings of a DeviceData
+# property history, newest first.  A packed history is read from the
+# series' NumPy arrays, it is never decoded into a list of dicts.
+def __iter_history_from_DS(device_data, key):
+    stored = device_data.get(key)
+    if not device_data_codec.is_packed(stored):
+        for val in stored or []: # the original list form, already decoded
+            yield utils.bytes_to_string(val['timestamp']), \
+                    utils.bytes_to_string(val['value'])
+        return
+    series = datastore.get_device_data_series_from_DeviceData(device_data, key)
+    # numeric values are float32, rendered as they were stored
+    to_string = '{:.7g}'.format if series.is_numeric() else str
+    for epoch, value in zip(series.timestamps.tolist(), 
+            series.values.tolist()):
+        yield device_data_codec.epoch_to_timestamp(epoch), to_string(value)
+
+
 # ------------------------------------------------------------------------------
 # Generic function to return a float value from DeviceData[key]
 def get_current_float_value_from_DS(key, device_uuid):
     if device_uuid is None or device_uuid is 'None':
         return None
 
-    device_data = get_by_key_from_DS(DS_device_data_KEY, device_uuid)
+    device_data = datastore.get_cached_device_data_from_DS(device_uuid)
     if device_data is None or key not in device_data:
         return None
 
     # process the vars list from the DS into the same format as BQ
     result = None
-    valuesList = device_data[key]
-    val = valuesList[0]  # the first item in the list is most recent
-    result = "{0:.2f}".format(float(val['value']))
+    # only the first (most recent) value is decoded
+    value, ts = datastore.get_latest_val_from_DeviceData(device_data, key)
+    result = "{0:.2f}".format(float(value))
     return result
 
 
@@ -122,7 +134,7 @@ def get_current_float_value_from_DS(key, device_uuid):
 # Returns a float or None.
 def get_current_CO2_value(device_uuid):
     # First: look in the Datastore Device data dict...
-    result = get_current_float_value_from_DS(DS_co2_KEY, device_uuid)
+    result = get_current_float_value_from_DS(datastore.DS_co2_KEY, device_uuid)
     if result is not None:
         return result
 
@@ -136,7 +148,7 @@ def get_current_CO2_value(device_uuid):
 # Returns a float or None.
 def get_current_temp_value(device_uuid):
     # First: look in the Datastore Device data dict...
-    result = get_current_float_value_from_DS(DS_temp_KEY, device_uuid)
+    result = get_current_float_value_from_DS(datastore.DS_temp_KEY, device_uuid)
     if result is not None:
         return result
 
@@ -150,7 +162,7 @@ def get_current_temp_value(device_uuid):
 # Returns a float or None.
 def get_current_RH_value(device_uuid):
     # First: look in the Datastore Device data dict...
-    result = get_current_float_value_from_DS(DS_rh_KEY, device_uuid)
+    result = get_current_float_value_from_DS(datastore.DS_rh_KEY, device_uuid)
     if result is not None:
         return result
 
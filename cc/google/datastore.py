@@ -1,13 +1,20 @@
 # https://google-cloud-python.readthedocs.io/en/stable/datastore/usage.html
 
 import datetime as dt
-import uuid, json, logging, time
+import uuid, json, logging, time, sys, traceback, random, copy, os, socket
 from typing import Any, List, Dict
 
-from google.cloud import datastore
-
 from cloud_common.cc import utils 
+from cloud_common.cc import parallel
+from cloud_common.cc.cache import TTLCache
+from cloud_common.cc.google import clients
 from cloud_common.cc.google import env_vars
+from cloud_common.cc.google import retry
+from cloud_common.cc.google import device_data_codec
+from cloud_common.cc.google.device_data_codec import DeviceDataSeries
+
+# Loaded on first use, it is slow to import.
+datastore = utils.lazy_import('google.cloud.datastore')
 
 
 # Entity types 
@@ -20,6 +27,12 @@ DS_hort_KIND = 'HorticultureMeasurements'
 DS_turds_KIND = 'MqttServiceTurds'
 DS_cache_KIND = 'MqttServiceCache'
 DS_images_KIND = 'Images'
+DS_counter_shard_KIND = 'EntityCounterShard'
+DS_device_data_property_KIND = 'DeviceDataProperty' # child of DeviceData
+DS_latest_image_KIND = 'LatestImage' # keyed by device_uuid
+DS_fleet_snapshot_KIND = 'FleetSnapshot' # keyed by device_uuid
+DS_pending_upload_KIND = 'PendingImageUpload' # keyed by file name
+DS_lease_KIND = 'Lease' # keyed by lease name
 
 
 # Keys for datastore DeviceData entity
@@ -36,73 +49,195 @@ DS_h20_ec_KEY = 'water_electrical_conductivity_ms_cm'
 DS_h20_ph_KEY = 'water_potential_hydrogen'
 DS_h20_temp_KEY = 'water_temperature_celcius'
 
+# Keys for datastore LastDeviceData entity
+DS_last_seen_KEY = 'last_seen' # indexed UTC datetime of the last status
+
+# Keys for datastore DeviceDataProperty entity 
+# (keyed DeviceData/<device_uuid>/DeviceDataProperty/<property name>)
+DS_values_KEY = 'values' # the list of dicts of one DeviceData property
+
+# Keys for datastore LatestImage entity (keyed LatestImage/<device_uuid>),
+# a copy of the newest Images entity of each device.
+DS_URL_KEY = 'URL'
+DS_camera_name_KEY = 'camera_name'
+DS_creation_date_KEY = 'creation_date'
+
+# Keys for datastore FleetSnapshot entity (keyed FleetSnapshot/<device_uuid>),
+# the per device summary shown by the device listings, kept up to date as 
+# data and images are saved: 
+#   remote_URL, access_point, the latest value of each of the 
+#   DS_fleet_snapshot_VALUE_KEYS, last_message_time, last_message_epoch 
+#   and last_image.
+DS_last_message_time_KEY = 'last_message_time' # '' for never
+DS_last_message_epoch_KEY = 'last_message_epoch' # int secs, None for never
+DS_fleet_snapshot_VALUE_KEYS = [DS_rh_KEY, DS_temp_KEY, DS_co2_KEY, 
+        DS_h20_ec_KEY, DS_h20_ph_KEY, DS_h20_temp_KEY]
+
+# Keys for datastore PendingImageUpload entity (and DS_device_uuid_KEY,
+# DS_camera_name_KEY)
+DS_created_epoch_KEY = 'created_epoch' # int secs
+
+# Keys for datastore Lease entity
+DS_lease_owner_KEY = 'owner'
+DS_lease_expires_KEY = 'expires_epoch' # float secs
+
+# DeviceData storage layouts (set with the DS_DEVICE_DATA_LAYOUT env. var.)
+DS_layout_ENTITY = 'entity' # every property on the one DeviceData entity
+DS_layout_CHILD = 'child'   # each property on its own DeviceDataProperty
+                            # child entity, so writes to different 
+                            # properties don't conflict.
+
 
 # How many entries are in the DeviceData queue of dicts.
 DS_env_vars_MAX_size = 100 # maximum number of values in each env. var list
 
+# Maximum number of keys the datastore allows in one lookup (get_multi).
+DS_get_multi_MAX_keys = 1000
+
+# Number of entities fetched per round trip by the paginated (iter_*) scans.
+DS_query_PAGE_size = 500
+
+# Maximum number of keys the datastore allows in one delete_multi / put_multi.
+DS_delete_multi_MAX_keys = 500
+
+# Most entity groups (here keys) written in one transaction.
+DS_transaction_MAX_keys = 25
+
+# Properties read by the listings when they use projection queries (opt in).
+# Only indexed properties can be projected, a projection of more than one 
+# property needs a composite index in index.yaml, for example:
+#   - kind: Devices
+#     properties:
+#     - name: device_name
+#     - name: device_uuid
+#     - name: user_uuid
+# and entities missing any projected property are not returned.
+# (the Devices listing shows the unindexed device_notes, so it can't project)
+DS_device_data_listing_PROPERTIES = ['device_name', 'device_uuid', 'user_uuid']
+DS_users_listing_PROPERTIES = ['date_added', 'email_address', 'organization',
+        'user_uuid', 'username']
+DS_users_lookup_PROPERTIES = ['user_uuid', 'username']
+
+# The longest the independent queries of an admin call (which are run in 
+# parallel) can take, before the call returns partial results.
+DS_parallel_TIMEOUT_secs = 30.0
+
+# Sharded entity counters, maintained on write and reconciled periodically.
+DS_counter_NUM_shards = 20
+DS_count_KEY = 'count'
+DS_counted_KINDS = [DS_devices_KIND, DS_device_data_KIND, DS_users_KIND, 
+        DS_hort_KIND, DS_cache_KIND, DS_turds_KIND, DS_images_KIND]
+# The kinds in the get_count_of_entities_from_DS() response (the same keys 
+# it has always had, Images is counted but not returned).
+DS_count_response_KINDS = [DS_devices_KIND, DS_device_data_KIND, 
+        DS_users_KIND, DS_hort_KIND, DS_cache_KIND, DS_turds_KIND]
+
+
+# In process cache of DeviceData entities, keyed by device_uuid.
+DS_device_data_cache_MAX_size = 500 # entities
+DS_device_data_cache_TTL_secs = 10 
+
+# In process cache of parsed boot messages, keyed by (device_uuid, boot 
+# timestamp), so each boot message is only JSON decoded once.  A boot message
+# never changes, so the entries don't expire.
+DS_boot_info_cache_MAX_size = 2000 # boot messages
+
 
 # Global
-__ds_client = None
+__device_data_cache = TTLCache(DS_device_data_cache_MAX_size, 
+        DS_device_data_cache_TTL_secs)
+__boot_info_cache = TTLCache(DS_boot_info_cache_MAX_size, None)
 
 
 #------------------------------------------------------------------------------
 # Datastore client for google cloud
+# (use get_client(), this makes a new client every time it is called)
 def create_client() -> Any:
     logging.debug(f'cloud_common.cc.google.datastore client created.')
     return datastore.Client(env_vars.cloud_project_id)
 
 
 #------------------------------------------------------------------------------
+# Returns the shared (per process) datastore client.
 def get_client() -> Any:
-    global __ds_client 
-    if __ds_client is None:
-        __ds_client = create_client()
-    return __ds_client
+    return clients.get_client(clients.DATASTORE)
+
+
+clients.register(clients.DATASTORE, create_client)
 
 
 #------------------------------------------------------------------------------
-# Returns dict of counts.
+# Generator that runs a query one page at a time, using cursors, and yields 
+# a list of entities for each page.  Only one page is in memory at a time
+# and the caller can stop early.
+def iter_query_pages_from_DS(query, page_size: int = DS_query_PAGE_size):
+    cursor = None
+    while True:
+        iterator = query.fetch(limit=page_size, start_cursor=cursor)
+        page = list(iterator) # this page of entities
+        if 0 < len(page):
+            yield page
+        cursor = iterator.next_page_token
+        if cursor is None or len(page) < page_size:
+            return # no more results
+
+
+#------------------------------------------------------------------------------
+# Generator that runs a query one page at a time, using cursors, and yields
+# each entity.
+def iter_query_from_DS(query, page_size: int = DS_query_PAGE_size):
+    for page in iter_query_pages_from_DS(query, page_size):
+        for entity in page:
+            yield entity
+
+
+#------------------------------------------------------------------------------
+# Returns dict of counts.  The counts are read in parallel, any that fail or
+# time out are None (and logged).
 def get_count_of_entities_from_DS():
+    calls = {}
+    for kind in DS_count_response_KINDS:
+        calls[kind] = lambda kind=kind: get_counted_entity_count_from_DS(kind)
+    calls['DeviceDataLastHour'] = get_DeviceData_active_last_hour_count_from_DS
+    counts = parallel.run_in_parallel(calls, DS_parallel_TIMEOUT_secs)
     res = {}
-    res[DS_devices_KIND] = get_entity_count_from_DS(DS_devices_KIND)
-    res[DS_device_data_KIND] = get_entity_count_from_DS(DS_device_data_KIND)
-    res[DS_users_KIND] = get_entity_count_from_DS(DS_users_KIND)
-    res[DS_hort_KIND] = get_entity_count_from_DS(DS_hort_KIND)
-    res[DS_cache_KIND] = get_entity_count_from_DS(DS_cache_KIND)
-    res[DS_turds_KIND] = get_entity_count_from_DS(DS_turds_KIND)
-    res['DeviceDataLastHour'] = get_DeviceData_active_last_hour_count_from_DS()
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    for name in calls:
+        res[name] = counts.get(name)
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
 #------------------------------------------------------------------------------
+# Count the devices that sent a status message in the last hour, with a keys
+# only inequality query on the indexed LastDeviceData.last_seen property.
+# (status messages are sent every 5 min.)
 def get_DeviceData_active_last_hour_count_from_DS():
     DS = get_client()
     if DS is None:
         return 0
-    query = DS.query(kind=DS_device_data_KIND)
-    entities = list(query.fetch()) # get all entities
+    one_hour_ago = dt.datetime.utcnow() - dt.timedelta(hours=1)
+    query = DS.query(kind=DS_last_device_data_KIND)
+    query.keys_only() # retuns less data, so faster
+    query.add_filter(DS_last_seen_KEY, '>', one_hour_ago)
     count = 0
-    utc = dt.datetime.utcnow() - dt.timedelta(hours=1)
-    one_hour_ago = utc.strftime('%FT%XZ')
-    for e in entities:
-        # status message are sent every 5 min.
-        status = e.get(DS_status_KEY, [None])[0]
-        #print( e.key.id_or_name )
-        if status is not None:
-            try:
-                ts = status.get('timestamp', b'')
-                ts = utils.bytes_to_string(ts)
-                if ts > one_hour_ago: 
-                    count = count + 1
-            except:
-                pass
-    
-#<Entity('DeviceData', 'EDU-11A8F684-f4-5e-ab-67-5d-ad') {'status': [<Entity {'timestamp': b'2018-11-16T15:58:07Z', 'value': b'{"timestamp": "2018-11-16T15:58:07Z", "IP": "10.33.136.13", "package_version": "1.0-4", "device_config": "edu-v0.3.0", "status": "OK", "internet_connection": "True", "memory_available": "98M", "disk_available": "945M", "iot_status": "2018-11-16-T15:46:42Z", "iot_received_message_count": 2, "iot_published_message_count": 2, "recipe_percent_complete": 33.199074074074076, "recipe_percent_complete_string": "33.20 %", "recipe_time_remaining_minutes": 28858, "recipe_time_remaining_string": "20 Days 0 Hours 58 Minutes", "recipe_time_elapsed_string": "9 Days 23 Hours 2 Minutes"}', 'name': b'None'}>,
-
+    for page in iter_query_pages_from_DS(query): # keys only pages
+        count += len(page)
     return count
 
 
+#------------------------------------------------------------------------------
+# Update the indexed last seen time on the small LastDeviceData entity for
+# this device.  These entities are custom keyed with our device_ID.
+def update_last_seen_in_DS(device_ID: str) -> None:
+    DS = get_client()
+    if DS is None:
+        return
+    key = DS.key(DS_last_device_data_KIND, device_ID)
+    last = datastore.Entity(key)
+    last[DS_last_seen_KEY] = dt.datetime.utcnow()
+    DS.put(last)
+
+
 #------------------------------------------------------------------------------
 def get_entity_count_from_DS(kind):
     DS = get_client()
@@ -115,11 +250,128 @@ def get_entity_count_from_DS(kind):
 
 
 #------------------------------------------------------------------------------
-def get_one_from_DS(kind, key, value):
+# Private: the keys of all the counter shards for an entity kind.
+def __get_counter_shard_keys(DS, kind):
+    return [DS.key(DS_counter_shard_KIND, f'{kind}-{shard}') 
+            for shard in range(DS_counter_NUM_shards)]
+
+
+#------------------------------------------------------------------------------
+# Add delta (can be negative) to a random counter shard of an entity kind.
+# The shards only exist after the kind has been reconciled once, until then
+# this does nothing (the first count will reconcile).
+# Returns True for success or False for error.
+def increment_entity_counter_in_DS(kind: str, delta: int = 1) -> bool:
+    DS = get_client()
+    if DS is None:
+        return False
+    key = DS.key(DS_counter_shard_KIND, 
+            f'{kind}-{random.randrange(DS_counter_NUM_shards)}')
+
+    def increment():
+        with DS.transaction():
+            shard = DS.get(key)
+            if shard is None:
+                return # not reconciled yet
+            shard[DS_count_KEY] = shard.get(DS_count_KEY, 0) + delta
+            DS.put(shard)
+
+    try:
+        retry.default_policy.call('increment_entity_counter_in_DS', increment)
+        return True
+    except Exception as e:
+        logging.error(f'increment_entity_counter_in_DS: transaction failed '
+                f'for kind={kind} delta={delta}: {e}')
+    return False
+
+
+#------------------------------------------------------------------------------
+# Sum the counter shards of an entity kind.
+# Returns the count, or None if the kind has never been reconciled.
+def get_entity_counter_from_DS(kind: str) -> Any:
     DS = get_client()
     if DS is None:
         return None
-    query = DS.query(kind=kind)
+    shards = DS.get_multi(__get_counter_shard_keys(DS, kind))
+    if not shards:
+        return None
+    return sum([s.get(DS_count_KEY, 0) for s in shards])
+
+
+#------------------------------------------------------------------------------
+# Correct the counter shards of an entity kind with a keys only scan.
+# The difference between the scan and the shards (read before it) is added 
+# to the first shard in a transaction, so increments made during the scan
+# are not lost.  Missing shards are created.
+# Returns the count.
+def reconcile_entity_counter_in_DS(kind: str) -> int:
+    DS = get_client()
+    if DS is None:
+        return 0
+    keys = __get_counter_shard_keys(DS, kind)
+    before = sum([s.get(DS_count_KEY, 0) for s in DS.get_multi(keys)])
+    count = get_entity_count_from_DS(kind)
+
+    def reconcile():
+        with DS.transaction():
+            shards = {}
+            for shard in DS.get_multi(keys):
+                shards[shard.key.id_or_name] = shard
+            changed = []
+            for key in keys:
+                if key.id_or_name not in shards:
+                    shard = datastore.Entity(key)
+                    shard['kind'] = kind
+                    shard[DS_count_KEY] = 0
+                    shards[key.id_or_name] = shard
+                    changed.append(shard)
+            first = shards[keys[0].id_or_name]
+            first[DS_count_KEY] = first.get(DS_count_KEY, 0) + count - before
+            if first not in changed:
+                changed.append(first)
+            DS.put_multi(changed)
+            return sum([s.get(DS_count_KEY, 0) for s in shards.values()])
+
+    try:
+        count = retry.default_policy.call('reconcile_entity_counter_in_DS',
+                reconcile)
+    except Exception as e:
+        logging.error(f'reconcile_entity_counter_in_DS: transaction failed '
+                f'for kind={kind}: {e}')
+    logging.info(f'reconcile_entity_counter_in_DS: kind={kind} count={count}')
+    return count
+
+
+#------------------------------------------------------------------------------
+# Rebuild all the entity counters.  Run this periodically (e.g. from cron)
+# to correct any drift, and to count writes made outside this module.
+# Returns a dict of counts.
+def reconcile_entity_counters_in_DS() -> Dict[str, int]:
+    res = {}
+    for kind in DS_counted_KINDS:
+        res[kind] = reconcile_entity_counter_in_DS(kind)
+    return res
+
+
+#------------------------------------------------------------------------------
+# Get the count of an entity kind from its counter shards, reconciling the
+# counter from a keys only scan the first time.
+def get_counted_entity_count_from_DS(kind: str) -> int:
+    count = get_entity_counter_from_DS(kind)
+    if count is None:
+        count = reconcile_entity_counter_in_DS(kind)
+    return count
+
+
+#------------------------------------------------------------------------------
+# Pass a list of property names as the projection to only get those 
+# properties (see DS_device_data_listing_PROPERTIES for the index needed, and
+# the filtered property can't be one of them).
+def get_one_from_DS(kind, key, value, projection: List[str] = None):
+    DS = get_client()
+    if DS is None:
+        return None
+    query = DS.query(kind=kind, projection=projection or ())
     query.add_filter(key, '=', value)
     result = list(query.fetch(1)) # just get the first one (no order)
     if not result:
@@ -128,16 +380,21 @@ def get_one_from_DS(kind, key, value):
 
 
 #------------------------------------------------------------------------------
-def get_all_from_DS(kind, key, value):
+# Optional projection, as in get_one_from_DS().
+def get_all_from_DS(kind, key, value, projection: List[str] = None):
+    return list(iter_all_from_DS(kind, key, value, projection=projection))
+
+
+#------------------------------------------------------------------------------
+# Generator version of get_all_from_DS(), yields the entities a page at a time.
+def iter_all_from_DS(kind, key, value, page_size: int = DS_query_PAGE_size,
+        projection: List[str] = None):
     DS = get_client()
     if DS is None:
-        return []
-    query = DS.query(kind=kind)
+        return
+    query = DS.query(kind=kind, projection=projection or ())
     query.add_filter(key, '=', value)
-    result = list(query.fetch()) # fetch all data
-    if not result:
-        return []
-    return result
+    yield from iter_query_from_DS(query, page_size)
 
 
 #------------------------------------------------------------------------------
@@ -152,6 +409,73 @@ def get_by_key_from_DS(kind, key):
     return _ent
 
 
+#------------------------------------------------------------------------------
+# Returns True if DeviceData properties are stored on child entities.
+def is_device_data_child_layout() -> bool:
+    return DS_layout_CHILD == env_vars.device_data_layout
+
+
+#------------------------------------------------------------------------------
+# Private: the key of the child entity that holds one DeviceData property.
+def __get_device_data_property_key(DS, device_ID, property_name):
+    return DS.key(DS_device_data_KIND, device_ID, 
+            DS_device_data_property_KIND, property_name)
+
+
+#------------------------------------------------------------------------------
+# Private: put the values of DeviceDataProperty child entities on their
+# DeviceData (parent) entities, creating the parents that don't exist.
+# Updates the dict of DeviceData entities keyed by device_uuid.
+def __put_children_on_device_data(DS, device_data, children):
+    for child in children:
+        device_uuid = child.key.parent.id_or_name
+        dd = device_data.get(device_uuid)
+        if dd is None:
+            dd = datastore.Entity(child.key.parent)
+            device_data[device_uuid] = dd
+        dd[child.key.id_or_name] = child.get(DS_values_KEY, [])
+
+
+#------------------------------------------------------------------------------
+# Get a DeviceData entity (not cached).  
+# With the child layout, the properties of the child entities are put on the
+# returned entity, over any (not yet migrated) properties on the parent.
+# Returns the entity or None.
+def get_device_data_entity_from_DS(device_uuid):
+    dd = get_by_key_from_DS(DS_device_data_KIND, device_uuid)
+    if not is_device_data_child_layout():
+        return dd
+    DS = get_client()
+    if DS is None:
+        return None
+    query = DS.query(kind=DS_device_data_property_KIND, 
+            ancestor=DS.key(DS_device_data_KIND, device_uuid))
+    device_data = {}
+    if dd is not None:
+        device_data[device_uuid] = dd
+    __put_children_on_device_data(DS, device_data, query.fetch())
+    return device_data.get(device_uuid)
+
+
+#------------------------------------------------------------------------------
+# Get a DeviceData entity through the in process cache.
+# The entity is shared with other callers, so treat it as read only.
+# Returns the entity or None.
+def get_cached_device_data_from_DS(device_uuid):
+    dd = __device_data_cache.get(device_uuid)
+    if dd is None:
+        dd = get_device_data_entity_from_DS(device_uuid)
+        if dd is not None:
+            __device_data_cache.put(device_uuid, dd)
+    return dd
+
+
+#------------------------------------------------------------------------------
+# Returns a dict of the DeviceData cache size and hit / miss counters.
+def get_device_data_cache_stats() -> Dict[str, int]:
+    return __device_data_cache.stats()
+
+
 #------------------------------------------------------------------------------
 def get_device_name_from_DS(device_uuid):
     DS = get_client()
@@ -172,12 +496,14 @@ def get_device_data_from_DS(device_uuid):
     if device_uuid is None or device_uuid is 'None':
         return None
 
-    device_data = get_by_key_from_DS(DS_device_data_KIND, device_uuid)
+    device_data = get_cached_device_data_from_DS(device_uuid)
     if device_data is None:
         return None
 
-    air_temperature_celcius = device_data.get(DS_temp_KEY, [{}])[0].get("value", '')
-    status = device_data.get(DS_status_KEY, [None])[0]
+    air_temperature_celcius, _ = get_latest_val_from_DeviceData(device_data,
+            DS_temp_KEY)
+    status = get_values_list_from_DeviceData(device_data, DS_status_KEY, 
+            [None])[0]
 
     result_json = {
         "timestamp": status.get("timestamp", ""),
@@ -202,15 +528,88 @@ def get_count_of_users_devices_from_DS(user_uuid):
 
 
 #------------------------------------------------------------------------------
-def get_list_of_users_from_DS():
+# Get a dict of the number of devices each user owns, keyed by user_uuid.
+# One scan of the Devices kind (instead of one query per user).
+def get_count_of_devices_by_user_from_DS():
+    counts = {}
+    DS = get_client()
+    if DS is None:
+        return counts
+    query = DS.query(kind=DS_devices_KIND, projection=['user_uuid'])
+    for d in iter_query_from_DS(query):
+        user_uuid = d.get('user_uuid', '')
+        counts[user_uuid] = counts.get(user_uuid, 0) + 1
+    return counts
+
+
+#------------------------------------------------------------------------------
+# Get a dict of the latest session created date string of each user, keyed by
+# user_uuid.  One scan of the UserSession kind (instead of one query per user).
+# This is read only, it does not delete any stale sessions.
+def get_latest_user_session_dates_from_DS():
+    dates = {}
+    DS = get_client()
+    if DS is None:
+        return dates
+    query = DS.query(kind=DS_user_session_KIND)
+    for s in iter_query_from_DS(query):
+        cd = s.get('created_date', None)
+        if cd is None:
+            continue
+        user_uuid = s.get('user_uuid', '')
+        date = cd.strftime('%FT%XZ')
+        if date > dates.get(user_uuid, ''):
+            dates[user_uuid] = date
+    return dates
+
+
+#------------------------------------------------------------------------------
+# Get the list of all users, with their device count and latest activity.
+# aggregate=True (the default) scans the Devices and UserSession kinds once 
+# each (in parallel) and joins the results onto the users in memory.  If a 
+# scan fails or times out, those fields are defaulted and the error is listed
+# in res[parallel.ERRORS_KEY].
+# aggregate=False runs two queries per user.
+# projection=True only reads DS_users_listing_PROPERTIES of each user.
+def get_list_of_users_from_DS(aggregate: bool = True, 
+        projection: bool = False):
     res = {}
     DS = get_client()
     if DS is None:
         return res
-    res['users'] = [] # list of users
-    query = DS.query(kind=DS_users_KIND)
-    users = list(query.fetch()) # get all users
-    for u in users:
+    errors = {}
+    res['users'] = list(iter_users_from_DS(aggregate, 
+        projection=projection, errors=errors)) # list of users
+    if 0 < len(errors):
+        res[parallel.ERRORS_KEY] = errors
+    res['timestamp'] = utils.utc_timestamp()
+    return res
+
+
+#------------------------------------------------------------------------------
+# Generator of the user dicts of get_list_of_users_from_DS(), the Users kind
+# is read a page at a time.  Aggregation errors are added to the errors dict
+# (if one is passed in).
+def iter_users_from_DS(aggregate: bool = True, 
+        page_size: int = DS_query_PAGE_size, projection: bool = False,
+        errors: Dict[str, str] = None):
+    DS = get_client()
+    if DS is None:
+        return
+
+    if aggregate:
+        agg = parallel.run_in_parallel({
+            'device_counts': get_count_of_devices_by_user_from_DS,
+            'session_dates': get_latest_user_session_dates_from_DS},
+            DS_parallel_TIMEOUT_secs)
+        device_counts = agg.get('device_counts', {})
+        session_dates = agg.get('session_dates', {})
+        if errors is not None:
+            errors.update(agg.get(parallel.ERRORS_KEY, {}))
+
+    query = DS.query(kind=DS_users_KIND, 
+            projection=DS_users_listing_PROPERTIES if projection else ())
+    for u in iter_query_from_DS(query, page_size):
         user = {}
         da = u.get('date_added', '')
         user["account_creation_date"] = da.strftime('%FT%XZ')
@@ -219,211 +618,602 @@ def get_list_of_users_from_DS():
         user["user_uuid"] = u.get('user_uuid', '')
         user["organization"] = u.get('organization', '')
 
-        user["number_of_devices"] = get_count_of_users_devices_from_DS(
-                user["user_uuid"])
+        if aggregate:
+            user["number_of_devices"] = device_counts.get(
+                    user["user_uuid"], 0)
+            adate = session_dates.get(user["user_uuid"])
+        else:
+            user["number_of_devices"] = get_count_of_users_devices_from_DS(
+                    user["user_uuid"])
+            adate = get_latest_user_session_created_date_from_DS(
+                    user["user_uuid"])
 
         user["account_activity_date"] = 'Never Active'
-        adate = get_latest_user_session_created_date_from_DS(user["user_uuid"])
         if adate is not None:
             user["account_activity_date"] = adate
 
-        res['users'].append(user)
+        yield user
 
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+
+#------------------------------------------------------------------------------
+# Private: get a list of entities for a list of keys, using batched lookups of
+# at most DS_get_multi_MAX_keys keys per round trip.
+def __get_multi_from_DS(DS, keys):
+    entities = []
+    for i in range(0, len(keys), DS_get_multi_MAX_keys):
+        entities.extend(DS.get_multi(keys[i:i + DS_get_multi_MAX_keys]))
+    return entities
+
+
+#------------------------------------------------------------------------------
+# Get a dict of entities keyed by their key name, using batched lookups of at
+# most DS_get_multi_MAX_keys keys per round trip.
+# Keys that are not found are not in the returned dict.
+def get_multi_by_key_from_DS(kind, keys):
+    res = {}
+    DS = get_client()
+    if DS is None:
+        return res
+    keys = [DS.key(kind, k) 
+            for k in set(keys) if k is not None and 0 < len(k)]
+    for e in __get_multi_from_DS(DS, keys):
+        res[e.key.id_or_name] = e
     return res
 
 
 #------------------------------------------------------------------------------
-def get_list_of_devices_from_DS():
+# Get a dict of DeviceData entities keyed by device_uuid, using batched 
+# lookups.  With the child layout only the properties passed in are fetched
+# (or all of them, with one query per device, if properties is None).
+def get_multi_device_data_from_DS(device_uuids, properties=None):
+    device_data = get_multi_by_key_from_DS(DS_device_data_KIND, device_uuids)
+    if not is_device_data_child_layout():
+        return device_data
+    DS = get_client()
+    if DS is None:
+        return device_data
+    device_uuids = [u for u in set(device_uuids) 
+            if u is not None and 0 < len(u)]
+    if properties is None:
+        for device_uuid in device_uuids:
+            dd = get_device_data_entity_from_DS(device_uuid)
+            if dd is not None:
+                device_data[device_uuid] = dd
+        return device_data
+    keys = [__get_device_data_property_key(DS, u, p) 
+            for u in device_uuids for p in properties]
+    __put_children_on_device_data(DS, device_data, 
+            __get_multi_from_DS(DS, keys))
+    return device_data
+
+
+#------------------------------------------------------------------------------
+# Get a dict of user entities keyed by user_uuid for the user_uuids passed in
+# (or all the users for None).
+# The Users kind is not keyed by user_uuid and our datastore client has no
+# IN filter, so this is one scan of the Users kind instead of one query 
+# per user_uuid.
+# Optional projection, as in get_one_from_DS().
+def get_users_by_uuid_from_DS(user_uuids, projection: List[str] = None):
     res = {}
     DS = get_client()
     if DS is None:
         return res
-    res['devices'] = [] # list of devices
-    query = DS.query(kind=DS_devices_KIND)
-    devices = list(query.fetch()) # get all devices 
-    for d in devices:
-        device = {}
-        rd = d.get('registration_date', None) # web ui reg date
-        if rd is None:
-            device['registration_date'] = ''
-        else:
-            device['registration_date'] = rd.strftime('%FT%XZ') 
-        device['device_name'] = d.get('device_name', '')
-        device['device_notes'] = d.get('device_notes', '')
-        device_uuid = d.get('device_uuid', '')
-        device['device_uuid'] = device_uuid
-        user_uuid = d.get('user_uuid', '')
-        device['user_uuid'] = user_uuid
-        device['last_config_send_time'] = 'Never' # in case no IoT device
-        device['last_error_message'] = 'No IoT registration'
-        device['user_name'] = 'None'
-        if 0 != len(user_uuid):
-            user = get_one_from_DS(DS_users_KIND, 'user_uuid', user_uuid)
-            if user is not None:
-                device['user_name'] = user.get('username','None')
-
-        device['remote_URL'] = ''
-        device['access_point'] = ''
-        if 0 < len(device_uuid):
-            dd = get_by_key_from_DS(DS_device_data_KIND, device_uuid)
-            if dd is not None and DS_boot_KEY in dd:
-                boot = dd.get(DS_boot_KEY) # list of boot messages
-
-                # get latest boot message
-                last_boot = boot[0].get('value')
-
-                # convert binary into string and then a dict
-                boot_dict = json.loads(utils.bytes_to_string(last_boot))
-
-                # the serveo link needs to be lower case
-                remote_URL = boot_dict.get('remote_URL')
-                if remote_URL is not None:
-                    remote_URL = remote_URL.lower()
-                    device['remote_URL'] = remote_URL
-
-                # get the AP
-                access_point = boot_dict.get('access_point')
-                if access_point is not None:
-                    # extract just the wifi code
-                    if access_point.startswith('BeagleBone-'):
-                        ap = access_point.split('-')
-                        if 2 <= len(ap):
-                            access_point = ap[1]
-                            device['access_point'] = access_point
-
-        res['devices'].append(device)
-
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    if user_uuids is not None:
+        user_uuids = set(user_uuids)
+        if 0 == len(user_uuids):
+            return res
+    query = DS.query(kind=DS_users_KIND, projection=projection or ())
+    for u in iter_query_from_DS(query):
+        user_uuid = u.get('user_uuid', '')
+        if user_uuids is None or user_uuid in user_uuids:
+            res[user_uuid] = u
     return res
 
 
 #------------------------------------------------------------------------------
-def get_list_of_device_data_from_DS():
+# Private: returns the dict of all users (by user_uuid) for the device
+# listings, which is read with one scan of the Users kind the first time a 
+# page of Devices entities has a user_uuid, then reused for the next pages.
+# users is None until then.
+# projection=True only reads DS_users_lookup_PROPERTIES of each user.
+def __get_users_for_devices(devices, users, projection: bool = False):
+    if users is not None:
+        return users
+    if all([0 == len(d.get('user_uuid', '')) for d in devices]):
+        return None
+    return get_users_by_uuid_from_DS(None, 
+            DS_users_lookup_PROPERTIES if projection else None)
+
+
+#------------------------------------------------------------------------------
+def get_list_of_devices_from_DS():
     res = {}
     DS = get_client()
     if DS is None:
         return res
-    res['devices'] = [] # list of devices with data from each
+    res['devices'] = list(iter_devices_from_DS()) # list of devices
+    res['timestamp'] = utils.utc_timestamp()
+    return res
+
+
+#------------------------------------------------------------------------------
+# Generator of the device dicts of get_list_of_devices_from_DS().  The Devices
+# kind is read a page at a time and the Users and FleetSnapshot entities for
+# each page are batch fetched.
+def iter_devices_from_DS(page_size: int = DS_query_PAGE_size):
+    DS = get_client()
+    if DS is None:
+        return
+    users = None # all user entities by user_uuid, read when first needed
     query = DS.query(kind=DS_devices_KIND)
-    devices = list(query.fetch()) # get all devices 
-    for d in devices:
-        device = {}
+    for devices in iter_query_pages_from_DS(query, page_size):
+        users = __get_users_for_devices(devices, users)
+        snapshots = get_multi_fleet_snapshots_from_DS(
+                [d.get('device_uuid', '') for d in devices])
+        for d in devices:
+            device = {}
+            rd = d.get('registration_date', None) # web ui reg date
+            if rd is None:
+                device['registration_date'] = ''
+            else:
+                device['registration_date'] = rd.strftime('%FT%XZ') 
+            device['device_name'] = d.get('device_name', '')
+            device['device_notes'] = d.get('device_notes', '')
+            device_uuid = d.get('device_uuid', '')
+            device['device_uuid'] = device_uuid
+            user_uuid = d.get('user_uuid', '')
+            device['user_uuid'] = user_uuid
+            device['last_config_send_time'] = 'Never' # in case no IoT device
+            device['last_error_message'] = 'No IoT registration'
+            device['user_name'] = 'None'
+            if 0 != len(user_uuid) and users is not None:
+                user = users.get(user_uuid)
+                if user is not None:
+                    device['user_name'] = user.get('username','None')
+
+            snapshot = snapshots.get(device_uuid, {})
+            device['remote_URL'] = snapshot.get('remote_URL', '')
+            device['access_point'] = snapshot.get('access_point', '')
+            yield device
+
+
+#------------------------------------------------------------------------------
+# projection=True only reads DS_device_data_listing_PROPERTIES of each device
+# and DS_users_lookup_PROPERTIES of each user.
+def get_list_of_device_data_from_DS(projection: bool = False):
+    res = {}
+    DS = get_client()
+    if DS is None:
+        return res
+    res['devices'] = list(iter_device_data_from_DS(
+        projection=projection)) # list of devices
+    res['timestamp'] = utils.utc_timestamp()
+    return res
 
-        device_uuid = d.get('device_uuid', '')
-        device['device_uuid'] = device_uuid
 
-        device['device_name'] = d.get('device_name', '')
+#------------------------------------------------------------------------------
+# Generator of the device dicts of get_list_of_device_data_from_DS().  The
+# Devices kind is read a page at a time and the Users and FleetSnapshot 
+# entities for each page are batch fetched.
+def iter_device_data_from_DS(page_size: int = DS_query_PAGE_size,
+        projection: bool = False):
+    DS = get_client()
+    if DS is None:
+        return
+    users = None # all user entities by user_uuid, read when first needed
+    query = DS.query(kind=DS_devices_KIND, 
+            projection=DS_device_data_listing_PROPERTIES if projection else ())
+    for devices in iter_query_pages_from_DS(query, page_size):
+        users = __get_users_for_devices(devices, users, projection)
+        snapshots = get_multi_fleet_snapshots_from_DS(
+                [d.get('device_uuid', '') for d in devices])
+        for d in devices:
+            device = {}
+
+            device_uuid = d.get('device_uuid', '')
+            device['device_uuid'] = device_uuid
+
+            device['device_name'] = d.get('device_name', '')
+
+            user_uuid = d.get('user_uuid', '')
+            device['user_name'] = user_uuid
+            if 0 != len(user_uuid) and users is not None:
+                user = users.get(user_uuid)
+                if user is not None:
+                    device['user_name'] = user.get('username','None')
+
+            snapshot = snapshots.get(device_uuid, {})
+            device['remote_URL'] = snapshot.get('remote_URL', '')
+            device['access_point'] = snapshot.get('access_point', '')
+            for key in DS_fleet_snapshot_VALUE_KEYS:
+                device[key] = snapshot.get(key, '')
+
+            last_message_time = snapshot.get(DS_last_message_time_KEY, '')
+            if 0 == len(last_message_time):
+                last_message_time = 'Never'
+            device['last_message_time'] = last_message_time 
+
+            epoch = snapshot.get(DS_last_message_epoch_KEY)
+            if epoch is None:
+                device['stale'] = get_minutes_since_UTC_timestamp(
+                        last_message_time)
+            else:
+                device['stale'] = str(utils.minutes_since_epoch(epoch))
+
+            device['last_image'] = snapshot.get('last_image', '')
+            yield device
 
-        user_uuid = d.get('user_uuid', '')
-        device['user_name'] = user_uuid
-        if 0 != len(user_uuid):
-            user = get_one_from_DS(DS_users_KIND, 'user_uuid', user_uuid)
-            if user is not None:
-                device['user_name'] = user.get('username','None')
-
-        # Get the DeviceData for this device ID
-        dd = None
-        if 0 < len(device_uuid):
-            dd = get_by_key_from_DS(DS_device_data_KIND, device_uuid)
-        
-        device['remote_URL'] = ''
-        device['access_point'] = ''
-        if dd is not None and DS_boot_KEY in dd:
-            boot = dd.get(DS_boot_KEY) # list of boot messages
-
-            # get latest boot message
-            last_boot = boot[0].get('value')
-
-            # convert binary into string and then a dict
-            boot_dict = json.loads(utils.bytes_to_string(last_boot))
-
-            # the serveo link needs to be lower case
-            remote_URL = boot_dict.get('remote_URL')
-            if remote_URL is not None:
-                remote_URL = remote_URL.lower()
-                device['remote_URL'] = remote_URL
-
-            # get the AP
-            access_point = boot_dict.get('access_point')
-            if access_point is not None:
-                # extract just the wifi code
-                if access_point.startswith('BeagleBone-'):
-                    ap = access_point.split('-')
-                    if 2 <= len(ap):
-                        access_point = ap[1]
-                        device['access_point'] = access_point
-
-        epoch = '1970-01-01T00:00:00Z'
-        last_message_time = epoch
-        val, ts = get_latest_val_from_DeviceData(dd, DS_rh_KEY)
-        device[DS_rh_KEY] = val
-        if ts > last_message_time:
-            last_message_time = ts
 
-        val, ts = get_latest_val_from_DeviceData(dd, DS_temp_KEY)
-        device[DS_temp_KEY] = val
-        if ts > last_message_time:
-            last_message_time = ts
+#------------------------------------------------------------------------------
+# Get the remote_URL and access_point of a device from one of its boot 
+# messages (value and timestamp), using the parsed boot message cache.
+# Returns a dict of them ('' for missing).
+def get_boot_info(device_uuid, last_boot, timestamp) -> Dict[str, str]:
+    if not timestamp:
+        return __parse_boot_info(last_boot) # can't tell boots apart
+    key = (device_uuid, timestamp)
+    info = __boot_info_cache.get(key)
+    if info is None:
+        info = __parse_boot_info(last_boot)
+        __boot_info_cache.put(key, info)
+    return dict(info) # callers can change their copy
 
-        val, ts = get_latest_val_from_DeviceData(dd, DS_co2_KEY)
-        device[DS_co2_KEY] = val
-        if ts > last_message_time:
-            last_message_time = ts
 
-        val, ts = get_latest_val_from_DeviceData(dd, DS_h20_ec_KEY)
-        device[DS_h20_ec_KEY] = val
-        if ts > last_message_time:
-            last_message_time = ts
+#------------------------------------------------------------------------------
+# Get the remote_URL and access_point of a device from the latest boot 
+# message in its DeviceData entity (which can be None).
+# Returns a dict of them ('' for missing).
+def get_boot_info_from_DeviceData(device_uuid, dd) -> Dict[str, str]:
+    if dd is None or DS_boot_KEY not in dd:
+        return {'remote_URL': '', 'access_point': ''}
+    last_boot, ts = get_latest_val_from_DeviceData(dd, DS_boot_KEY)
+    return get_boot_info(device_uuid, last_boot, ts)
 
-        val, ts = get_latest_val_from_DeviceData(dd, DS_h20_ph_KEY)
-        device[DS_h20_ph_KEY] = val
-        if ts > last_message_time:
-            last_message_time = ts
 
-        val, ts = get_latest_val_from_DeviceData(dd, DS_h20_temp_KEY)
-        device[DS_h20_temp_KEY] = val
+#------------------------------------------------------------------------------
+def get_boot_info_cache_stats() -> Dict[str, int]:
+    return __boot_info_cache.stats()
+
+
+#------------------------------------------------------------------------------
+# Private: parse a boot message value.
+def __parse_boot_info(last_boot):
+    info = {'remote_URL': '', 'access_point': ''}
+    try:
+        # convert binary into string and then a dict
+        boot_dict = json.loads(utils.bytes_to_string(last_boot))
+    except ValueError as e:
+        logging.error(f'datastore.__parse_boot_info: bad boot message: {e}')
+        return info
+
+    # the serveo link needs to be lower case
+    remote_URL = boot_dict.get('remote_URL')
+    if remote_URL is not None:
+        info['remote_URL'] = remote_URL.lower()
+
+    # get the AP
+    access_point = boot_dict.get('access_point')
+    if access_point is not None:
+        # extract just the wifi code
+        if access_point.startswith('BeagleBone-'):
+            ap = access_point.split('-')
+            if 2 <= len(ap):
+                info['access_point'] = ap[1]
+    return info
+
+
+#------------------------------------------------------------------------------
+# Private: returns a new FleetSnapshot entity for a device, built from its
+# DeviceData entity (which can be None) and latest image URL.
+def __build_fleet_snapshot(DS, device_uuid, dd, image_URL):
+    snapshot = datastore.Entity(DS.key(DS_fleet_snapshot_KIND, device_uuid))
+    snapshot.update(get_boot_info_from_DeviceData(device_uuid, dd))
+    last_message_time = ''
+    for key in DS_fleet_snapshot_VALUE_KEYS:
+        val, ts = get_latest_val_from_DeviceData(dd, key)
+        snapshot[key] = val
         if ts > last_message_time:
             last_message_time = ts
+    snapshot[DS_last_message_time_KEY] = last_message_time
+    snapshot[DS_last_message_epoch_KEY] = __get_epoch_of_value(
+            {'timestamp': last_message_time})
+    snapshot['last_image'] = image_URL
+    snapshot.exclude_from_indexes = snapshot.keys()
+    return snapshot
 
-        if last_message_time == epoch:
-            last_message_time = 'Never'
-        device['last_message_time'] = last_message_time 
 
-        device['stale'] = get_minutes_since_UTC_timestamp(last_message_time)
+#------------------------------------------------------------------------------
+# Private: build the FleetSnapshot entities of a list of devices from their
+# DeviceData and latest images (they are not saved).
+# Returns a dict of the snapshots by device_uuid.
+def __build_fleet_snapshots(DS, device_uuids):
+    res = {}
+    device_data = get_multi_device_data_from_DS(device_uuids, 
+            [DS_boot_KEY] + DS_fleet_snapshot_VALUE_KEYS)
+    image_URLs = get_latest_image_URLs(device_uuids)
+    for device_uuid in device_uuids:
+        res[device_uuid] = __build_fleet_snapshot(DS, device_uuid, 
+                device_data.get(device_uuid), 
+                image_URLs.get(device_uuid, ''))
+    return res
 
-        device['last_image'] = get_latest_image_URL(device_uuid)
 
-        res['devices'].append(device)
+#------------------------------------------------------------------------------
+# Private: save new entities (dict by key name) that don't exist yet, in 
+# transactions of at most DS_transaction_MAX_keys keys, so an entity
+# written since they were built is not overwritten.
+# Returns the number of entities saved.
+def __insert_if_absent_in_DS(DS, site, entities):
+    count = 0
+    new = list(entities.values())
+    for i in range(0, len(new), DS_transaction_MAX_keys):
+        chunk = new[i:i + DS_transaction_MAX_keys]
+
+        def insert():
+            with DS.transaction():
+                existing = set([e.key.id_or_name 
+                    for e in DS.get_multi([e.key for e in chunk])])
+                absent = [e for e in chunk 
+                        if e.key.id_or_name not in existing]
+                DS.put_multi(absent)
+            return len(absent)
+
+        try:
+            count += retry.default_policy.call(site, insert)
+        except Exception as e:
+            # they are saved on the next run
+            logging.error(f'{site}: insert failed: {e}')
+    return count
 
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
-    return res
+
+#------------------------------------------------------------------------------
+# Get a dict of the FleetSnapshot entities of a list of devices, keyed by 
+# device_uuid, using batched lookups.  Missing snapshots (new devices, or 
+# devices that have not sent data since we started keeping them) are built
+# from the DeviceData, but not saved (reads don't write), run
+# rebuild_fleet_snapshots_in_DS(missing_only=True) to save them.
+def get_multi_fleet_snapshots_from_DS(device_uuids):
+    DS = get_client()
+    if DS is None:
+        return {}
+    snapshots = get_multi_by_key_from_DS(DS_fleet_snapshot_KIND, device_uuids)
+    missing = [u for u in set(device_uuids) 
+            if u is not None and 0 < len(u) and u not in snapshots]
+    if 0 < len(missing):
+        snapshots.update(__build_fleet_snapshots(DS, missing))
+    return snapshots
+
+
+#------------------------------------------------------------------------------
+# Incrementally update the FleetSnapshot of a device with the latest of the
+# values just pushed onto its DeviceData queues (dicts are oldest first, as
+# in push_dicts_onto_device_data_queues()), and/or a new latest image URL.
+# A device without a snapshot is left for rebuild_fleet_snapshots_in_DS()
+# to build in full.
+# (The DeviceData writes update the snapshot in their own transaction, with
+# __get_fleet_snapshot_changes() and __update_fleet_snapshot(), this is for 
+# other callers.)
+# Returns True if the snapshot was updated.
+def update_fleet_snapshot_in_DS(device_ID: str, 
+        pushes: Dict[str, List[Dict]] = None, image_URL: str = None) -> bool:
+    latest = __get_fleet_snapshot_changes(pushes)
+    if 0 == len(latest) and image_URL is None:
+        return False # nothing on the snapshot changed
+    DS = get_client()
+    if DS is None:
+        return False
+
+    def update():
+        with DS.transaction():
+            snapshot = DS.get(DS.key(DS_fleet_snapshot_KIND, device_ID))
+            if snapshot is None:
+                return False
+            __update_fleet_snapshot(device_ID, snapshot, latest, image_URL)
+            DS.put(snapshot)
+            return True
+
+    try:
+        return retry.default_policy.call('update_fleet_snapshot_in_DS', 
+                update)
+    except Exception as e:
+        # the snapshot is stale until the next rebuild
+        logging.error(f'update_fleet_snapshot_in_DS: failed for '
+                f'device_ID={device_ID}: {e}')
+        return False
+
+
+#------------------------------------------------------------------------------
+# Private: returns a dict of the property name: newest pushed dict of the 
+# pushes that are on the FleetSnapshot.
+def __get_fleet_snapshot_changes(pushes: Dict[str, List[Dict]]) -> Dict:
+    latest = {} 
+    for key in [DS_boot_KEY] + DS_fleet_snapshot_VALUE_KEYS:
+        if 0 < len((pushes or {}).get(key, [])):
+            latest[key] = pushes[key][-1]
+    return latest
+
+
+#------------------------------------------------------------------------------
+# Private: update a FleetSnapshot entity with the changes from 
+# __get_fleet_snapshot_changes() and/or a new latest image URL.
+def __update_fleet_snapshot(device_ID, snapshot, latest, image_URL=None):
+    for key, pydict in latest.items():
+        value = pydict.get('value', '')
+        if DS_boot_KEY == key:
+            snapshot.update(get_boot_info(device_ID, value,
+                pydict.get('timestamp', '')))
+            continue
+        snapshot[key] = value
+        ts = pydict.get('timestamp', '')
+        if ts > snapshot.get(DS_last_message_time_KEY, ''):
+            snapshot[DS_last_message_time_KEY] = ts
+            snapshot[DS_last_message_epoch_KEY] = __get_epoch_of_value(pydict)
+    if image_URL is not None:
+        snapshot['last_image'] = image_URL
+    snapshot.exclude_from_indexes = snapshot.keys()
+
+
+#------------------------------------------------------------------------------
+# Private: for a transaction that writes some of a device's entities, get 
+# them and its FleetSnapshot (if there are changes for it) in one lookup.
+# Returns (dict of the entities by key, list of the updated snapshot to 
+# also put, or empty).
+def __get_multi_with_fleet_snapshot(DS, device_ID, keys, latest, 
+        image_URL=None):
+    snapkey = DS.key(DS_fleet_snapshot_KIND, device_ID)
+    if 0 < len(latest) or image_URL is not None:
+        keys = keys + [snapkey]
+    entities = {}
+    for e in DS.get_multi(keys):
+        entities[e.key] = e
+    snapshot = entities.pop(snapkey, None)
+    if snapshot is None:
+        return entities, [] # left for rebuild_fleet_snapshots_in_DS()
+    __update_fleet_snapshot(device_ID, snapshot, latest, image_URL)
+    return entities, [snapshot]
+
+
+#------------------------------------------------------------------------------
+# Private: the epoch secs of a DeviceData value dict, from its optional 
+# 'epoch' or else its timestamp (None if neither is usable).
+def __get_epoch_of_value(pydict):
+    if 'epoch' in pydict:
+        return int(pydict['epoch'])
+    try:
+        return utils.timestamp_to_epoch(pydict.get('timestamp', ''))
+    except ValueError:
+        return None
+
+
+#------------------------------------------------------------------------------
+# Rebuild all the FleetSnapshot entities from the DeviceData, a page of 
+# devices at a time.  Run this to recover from any drift (failed updates).
+# With missing_only=True, only the devices without a snapshot are built and
+# saved (if there still isn't one), run this periodically (not on a read
+# path) so new devices get one.
+# Returns the number of snapshots saved.
+def rebuild_fleet_snapshots_in_DS(page_size: int = DS_query_PAGE_size,
+        missing_only: bool = False) -> int:
+    DS = get_client()
+    if DS is None:
+        return 0
+    count = 0
+    query = DS.query(kind=DS_devices_KIND, projection=['device_uuid'])
+    for devices in iter_query_pages_from_DS(query, page_size):
+        device_uuids = [d.get('device_uuid', '') for d in devices]
+        device_uuids = [u for u in set(device_uuids) if 0 < len(u)]
+        if missing_only:
+            existing = get_multi_by_key_from_DS(DS_fleet_snapshot_KIND, 
+                    device_uuids)
+            device_uuids = [u for u in device_uuids if u not in existing]
+            if 0 == len(device_uuids):
+                continue
+            count += __insert_if_absent_in_DS(DS, 
+                    'rebuild_fleet_snapshots_in_DS',
+                    __build_fleet_snapshots(DS, device_uuids))
+            continue
+        snapshots = list(__build_fleet_snapshots(DS, device_uuids).values())
+        for i in range(0, len(snapshots), DS_delete_multi_MAX_keys):
+            DS.put_multi(snapshots[i:i + DS_delete_multi_MAX_keys])
+        count += len(snapshots)
+    logging.info(f'rebuild_fleet_snapshots_in_DS: saved {count}')
+    return count
 
 
 #------------------------------------------------------------------------------
 # Returns '' for failure or the latest URL published by this device.
 def get_latest_image_URL(device_uuid):
-    URL = ''
+    return get_latest_image_URLs([device_uuid]).get(device_uuid, '')
+
+
+#------------------------------------------------------------------------------
+# Get a dict of the latest image URL of each device, keyed by device_uuid
+# ('' if the device has no images).
+# Reads the LatestImage pointers with batched lookups.  Devices without a 
+# pointer (images saved before we kept them) fall back to the sorted Images
+# query, the pointers are not saved here (reads don't write), run
+# backfill_latest_images_in_DS() to save them.
+def get_latest_image_URLs(device_uuids):
+    res = {}
+    DS = get_client()
+    if DS is None:
+        return res
+    pointers = get_multi_by_key_from_DS(DS_latest_image_KIND, device_uuids)
+    pointers.update(__get_missing_latest_image_pointers(DS, device_uuids, 
+        pointers))
+    for device_uuid, pointer in pointers.items():
+        res[device_uuid] = decode_url(pointer)
+    return res
+
+
+#------------------------------------------------------------------------------
+# Save a LatestImage pointer for each device that doesn't have one (if there
+# still isn't one, saveImageURL() may have saved a newer one), a page of 
+# devices at a time.  Run this after upgrading, and periodically (not on a
+# read path).
+# Returns the number of pointers saved.
+def backfill_latest_images_in_DS(page_size: int = DS_query_PAGE_size) -> int:
     DS = get_client()
     if DS is None:
-        return URL
+        return 0
+    count = 0
+    query = DS.query(kind=DS_devices_KIND, projection=['device_uuid'])
+    for devices in iter_query_pages_from_DS(query, page_size):
+        device_uuids = [d.get('device_uuid', '') for d in devices]
+        pointers = get_multi_by_key_from_DS(DS_latest_image_KIND, 
+                device_uuids)
+        backfill = __get_missing_latest_image_pointers(DS, device_uuids, 
+                pointers)
+        if 0 < len(backfill):
+            count += __insert_if_absent_in_DS(DS, 
+                    'backfill_latest_images_in_DS', backfill)
+    logging.info(f'backfill_latest_images_in_DS: saved {count}')
+    return count
+
+
+#------------------------------------------------------------------------------
+# Private: returns a dict by device_uuid of new (not saved) LatestImage 
+# pointers, from the Images query, for the devices not in pointers.
+def __get_missing_latest_image_pointers(DS, device_uuids, pointers):
+    res = {}
+    for device_uuid in set(device_uuids):
+        if device_uuid is None or 0 == len(device_uuid):
+            continue
+        if device_uuid not in pointers:
+            res[device_uuid] = __get_latest_image_pointer(DS, device_uuid,
+                    __query_latest_image_from_DS(DS, device_uuid))
+    return res
+
 
-    # Sort by date descending and take the first 50
-    # This is equivalent to taking the most recent 50 images
-    # Then, reverse the order so it's chronological
+#------------------------------------------------------------------------------
+# Private: returns the newest Images entity of a device, or None.
+# (uses the composite index on device_uuid and creation_date)
+def __query_latest_image_from_DS(DS, device_uuid):
     image_query = DS.query(kind=DS_images_KIND,
                                          order=['-creation_date'])
     image_query.add_filter('device_uuid', '=', device_uuid)
-
-    image_list = list(image_query.fetch(1))[::-1]
+    image_list = list(image_query.fetch(1))
     if not image_list:
-        return URL
+        return None
+    return image_list[0]
 
-    image_entity = image_list[0]
-    if not image_entity:
-        return URL
-    URL = decode_url(image_entity)
-    return URL
+
+#------------------------------------------------------------------------------
+# Private: returns a LatestImage entity for a device that points at an Images
+# entity (an empty pointer if image_entity is None).
+def __get_latest_image_pointer(DS, device_uuid, image_entity):
+    pointer = datastore.Entity(DS.key(DS_latest_image_KIND, device_uuid),
+            exclude_from_indexes=[DS_URL_KEY])
+    pointer[DS_URL_KEY] = ''
+    pointer[DS_camera_name_KEY] = ''
+    pointer[DS_creation_date_KEY] = ''
+    if image_entity:
+        pointer[DS_URL_KEY] = decode_url(image_entity)
+        pointer[DS_camera_name_KEY] = image_entity.get(DS_camera_name_KEY, '')
+        pointer[DS_creation_date_KEY] = image_entity.get(
+                DS_creation_date_KEY, '')
+    return pointer
 
 
 #------------------------------------------------------------------------------
@@ -434,17 +1224,29 @@ def decode_url(image_entity):
 
 #------------------------------------------------------------------------------
 # Returns the value, timestamp if the key exists
+# (only the latest value is decoded, in either encoding)
 def get_latest_val_from_DeviceData(dd, key):
     if dd is None or key not in dd:
         return '', ''
-    valsList = dd.get(key, []) # list of values
-    # return latest value and timestamp
-    value = valsList[0].get('value', b'')
-    value = utils.bytes_to_string(value) # could be bytes, so decode
+    return DeviceDataSeries(dd.get(key)).latest()
+
+
+#------------------------------------------------------------------------------
+# Returns the list of dicts of a DeviceData property, in either encoding, 
+# or default if the key doesn't exist.
+def get_values_list_from_DeviceData(dd, key, default=None):
+    if dd is None or key not in dd:
+        return default
+    return device_data_codec.decode(dd.get(key))
+
 
-    ts = valsList[0].get('timestamp', b'') 
-    ts = utils.bytes_to_string(ts) # could be bytes, so decode
-    return value, ts
+#------------------------------------------------------------------------------
+# Returns a lazily decoded DeviceDataSeries of a DeviceData property, with
+# NumPy arrays of the timestamps and values.  Empty if the key doesn't exist.
+def get_device_data_series_from_DeviceData(dd, key) -> DeviceDataSeries:
+    if dd is None:
+        return DeviceDataSeries(None)
+    return DeviceDataSeries(dd.get(key))
 
 
 #------------------------------------------------------------------------------
@@ -453,32 +1255,67 @@ def get_latest_val_from_DeviceData(dd, key):
 def get_minutes_since_UTC_timestamp(ts):
     if ts == 'Never':
         return ts
-    now = dt.datetime.utcnow()
-    ts = dt.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ') # string to dt obj
-    delta = now - ts
-    minutes = delta.total_seconds() / 60.0
-    return "{}".format(int(minutes))
+    epoch = utils.timestamp_to_epoch(ts) # string to epoch secs
+    return "{}".format(utils.minutes_since_epoch(epoch))
 
 
 #------------------------------------------------------------------------------
+# Returns the latest session created date string of a user, or None.
+# This is read only, stale sessions are removed by 
+# delete_stale_user_sessions_from_DS().
 def get_latest_user_session_created_date_from_DS(user_uuid):
-    DS = get_client()
-    if DS is None:
-        return None
-    sessions = get_all_from_DS(DS_user_session_KIND, 'user_uuid', user_uuid)
-    if sessions is None or 0 == len(sessions):
-        return None
-    dates = []
-    for s in sessions:
-        dates.append(s.get('created_date', '').strftime('%FT%XZ'))
-    dates.sort(reverse=True) # sort descending, newest date on top
+    latest = None
+    for s in iter_all_from_DS(DS_user_session_KIND, 'user_uuid', user_uuid):
+        cd = s.get('created_date', None)
+        if cd is None:
+            continue
+        date = cd.strftime('%FT%XZ')
+        if latest is None or date > latest:
+            latest = date
+    return latest
 
-    # delete all the old (stale) sessions that are not the latest
-    for s in sessions:
-        if dates[0] != s.get('created_date', '').strftime('%FT%XZ'):
-            DS.delete(key=s.key)
 
-    return dates[0] # return the latest date (top of array)
+#------------------------------------------------------------------------------
+# Session garbage collection, run this periodically (not on a read path).
+# Streams the UserSession kind and keeps only the newest session of each 
+# user, all the older (stale) sessions are deleted in batches of
+# DS_delete_multi_MAX_keys keys.  Sessions without a created_date are left.
+# Returns a dict of stats: 
+#   {'scanned': sessions read, 'deleted': sessions deleted, 'seconds': time}
+def delete_stale_user_sessions_from_DS(page_size: int = DS_query_PAGE_size):
+    start = time.time()
+    res = {'scanned': 0, 'deleted': 0, 'seconds': 0.0}
+    DS = get_client()
+    if DS is None:
+        return res
+    newest = {} # user_uuid: (created_date, key) of the newest session so far
+    stale_keys = []
+    query = DS.query(kind=DS_user_session_KIND)
+    for s in iter_query_from_DS(query, page_size):
+        res['scanned'] += 1
+        cd = s.get('created_date', None)
+        if cd is None:
+            continue
+        user_uuid = s.get('user_uuid', '')
+        kept = newest.get(user_uuid)
+        if kept is None or cd > kept[0]:
+            newest[user_uuid] = (cd, s.key)
+            if kept is not None:
+                stale_keys.append(kept[1])
+        else:
+            stale_keys.append(s.key)
+        if len(stale_keys) >= DS_delete_multi_MAX_keys:
+            DS.delete_multi(stale_keys)
+            res['deleted'] += len(stale_keys)
+            stale_keys = []
+    if 0 < len(stale_keys):
+        DS.delete_multi(stale_keys)
+        res['deleted'] += len(stale_keys)
+    res['seconds'] = round(time.time() - start, 3)
+    logging.info(f'datastore.delete_stale_user_sessions_from_DS: '
+            f'deleted {res["deleted"]} of {res["scanned"]} sessions in '
+            f'{res["seconds"]} secs.')
+    return res
 
 
 #------------------------------------------------------------------------------
@@ -491,6 +1328,7 @@ def delete_user_from_DS(user_uuid):
     if user is None:
         return False
     DS.delete(key=user.key)
+    increment_entity_counter_in_DS(DS_users_KIND, -1)
     return True
 
 
@@ -514,6 +1352,7 @@ def add_user_to_DS(username, email_address, organization):
     })
     DS.put(add_user_task)
     if add_user_task.key:
+        increment_entity_counter_in_DS(DS_users_KIND)
         return user_uuid
     return None
 
@@ -528,17 +1367,30 @@ def delete_device_from_DS(device_uuid):
     device = get_one_from_DS(DS_devices_KIND, 'device_uuid', device_uuid)
     if device is not None:
         DS.delete(key=device.key)
+        increment_entity_counter_in_DS(DS_devices_KIND, -1)
 
-    device_data = get_by_key_from_DS(DS_device_data_KIND, device_uuid)
+    # (not get_by_key_from_DS, the entity is empty with the child layout)
+    device_data = DS.get(DS.key(DS_device_data_KIND, device_uuid))
     if device_data is not None:
         DS.delete(key=device_data.key)
-
-    # This entity does not exist as of 2019-01-07 but will when Rob adds it to
-    # the MQTT service.  This call will just return None until then.
+        increment_entity_counter_in_DS(DS_device_data_KIND, -1)
+
+    # Delete any DeviceDataProperty child entities.
+    query = DS.query(kind=DS_device_data_property_KIND, 
+            ancestor=DS.key(DS_device_data_KIND, device_uuid))
+    query.keys_only()
+    child_keys = [e.key for e in query.fetch()]
+    if 0 < len(child_keys):
+        DS.delete_multi(child_keys)
+    __device_data_cache.invalidate(device_uuid)
+
+    # This entity holds the indexed last seen time of the device.
     last_device_data = get_by_key_from_DS(DS_last_device_data_KIND, device_uuid)
     if last_device_data is not None:
         DS.delete(key=last_device_data.key)
 
+    DS.delete(DS.key(DS_latest_image_KIND, device_uuid))
+    DS.delete(DS.key(DS_fleet_snapshot_KIND, device_uuid))
     return True
 
 
@@ -561,23 +1413,48 @@ def add_device_to_DS(device_name, device_notes):
     })
     DS.put(add_device_task)
     if add_device_task.key:
+        increment_entity_counter_in_DS(DS_devices_KIND)
         return device_uuid
     return None
 
 
 #------------------------------------------------------------------------------
 # Get the DeviceData property list of dicts.
+# Pass use_cache=False to read the datastore, when the list will be modified
+# and saved (the cache can be up to DS_device_data_cache_TTL_secs stale, 
+# and another process may have written since).
 # Returns a list of dicts.
-def get_device_data_property(device_ID: str, property_name: str) -> List[Dict[str, str]]:
+def get_device_data_property(device_ID: str, property_name: str,
+        use_cache: bool = True) -> List[Dict[str, str]]:
     if device_ID is None or device_ID is 'None' or \
             property_name is None or property_name is 'None':
         return [{}]
 
-    dd = get_by_key_from_DS(DS_device_data_KIND, device_ID)
+    if not use_cache:
+        dd = get_device_data_entity_from_DS(device_ID)
+        if dd is None:
+            return [{}]
+        return get_values_list_from_DeviceData(dd, property_name, [{}])
+
+    dd = get_cached_device_data_from_DS(device_ID)
     if dd is None:
         return [{}]
 
-    return dd.get(property_name, [{}])
+    # callers modify the list, so give them a copy of a cached list (a 
+    # packed one is decoded into a new list)
+    values = get_values_list_from_DeviceData(dd, property_name, [{}])
+    if device_data_codec.is_packed(dd.get(property_name)):
+        return values
+    return copy.deepcopy(values)
+
+
+#------------------------------------------------------------------------------
+# Get a DeviceData property as a lazily decoded DeviceDataSeries, for
+# charting with NumPy.
+def get_device_data_series(device_ID: str, 
+        property_name: str) -> DeviceDataSeries:
+    dd = get_cached_device_data_from_DS(device_ID)
+    return get_device_data_series_from_DeviceData(dd, property_name)
 
 
 #------------------------------------------------------------------------------
@@ -585,6 +1462,51 @@ def get_device_data_property(device_ID: str, property_name: str) -> List[Dict[st
 # that produced them - for UI display / charting.
 def push_dict_onto_device_data_queue(device_ID: str, 
         property_name: str, pydict: Dict) -> bool:
+    return push_dicts_onto_device_data_queues(device_ID, 
+            {property_name: [pydict]})
+
+
+#------------------------------------------------------------------------------
+# Returns True if DeviceData histories are stored as packed blobs.
+def is_device_data_packed_encoding() -> bool:
+    return device_data_codec.ENCODING_PACKED == env_vars.device_data_encoding
+
+
+#------------------------------------------------------------------------------
+# Private: returns the value to store for a history list, a packed blob if
+# that encoding is on (and the list can be packed), else the list.
+def __encode_values_list(valuesList: List) -> Any:
+    if is_device_data_packed_encoding():
+        blob = device_data_codec.encode(valuesList)
+        if blob is not None:
+            return blob
+    return valuesList
+
+
+#------------------------------------------------------------------------------
+# Private: put dicts (oldest first) on the front of a stored list of values
+# (in either encoding), capped at DS_env_vars_MAX_size.  
+# Returns the value to store.
+def __push_onto_values_list(stored: Any, pydicts: List[Dict]) -> Any:
+    valuesList = device_data_codec.decode(stored)
+    # put these values at the front of the list
+    for pydict in pydicts:
+        valuesList.insert(0, pydict)
+    # cap max size of list
+    while len(valuesList) > DS_env_vars_MAX_size:
+        valuesList.pop() # remove last item in list
+    return __encode_values_list(valuesList)
+
+
+#------------------------------------------------------------------------------
+# Push many dicts onto many DeviceData property queues of one device, in 
+# one transaction.
+# Args:
+#   device_ID: the device (and DeviceData entity key).
+#   pushes: dict of property name to a list of dicts in the order they
+#           were received (oldest first), the newest ends up on top.
+def push_dicts_onto_device_data_queues(device_ID: str, 
+        pushes: Dict[str, List[Dict]]) -> bool:
     try:
         DS = get_client()
         if DS is None:
@@ -594,54 +1516,84 @@ def push_dict_onto_device_data_queue(device_ID: str,
         # These DeviceData entities are custom keyed with our device_ID.
         ddkey = DS.key(DS_device_data_KIND, device_ID)
         dd = DS.get(ddkey) 
-        if not dd: 
+        if dd is None: 
             # The device data entity doesn't exist, so create it
             dd = datastore.Entity(ddkey)
             dd.update({})   # empty entity
             DS.put(dd)      # write to DS
+            increment_entity_counter_in_DS(DS_device_data_KIND)
+
+        # The FleetSnapshot is updated in the same transaction.
+        latest = __get_fleet_snapshot_changes(pushes)
+
+        def update():
+            with DS.transaction():
+                entities, snapshots = __get_multi_with_fleet_snapshot(DS, 
+                        device_ID, [ddkey], latest)
+                dd = entities[ddkey]
+
+                for property_name, pydicts in pushes.items():
+                    # get a property named for the env var, which is a 
+                    # list of dict values
+                    dd[property_name] = __push_onto_values_list(
+                            dd.get(property_name, []), pydicts)
+
+                # save the entity to the datastore
+                dd.exclude_from_indexes = dd.keys()
+                DS.put_multi([dd] + snapshots)  
+            return dd
+
+        # Only the child entities of the pushed properties are written.
+        def update_children():
+            with DS.transaction():
+                keys = [__get_device_data_property_key(DS, device_ID, p) 
+                        for p in pushes]
+                entities, snapshots = __get_multi_with_fleet_snapshot(DS, 
+                        device_ID, keys, latest)
+                children = {}
+                for child in entities.values():
+                    children[child.key.id_or_name] = child
+                for key in keys:
+                    child = children.get(key.id_or_name)
+                    if child is None:
+                        child = datastore.Entity(key, 
+                                exclude_from_indexes=[DS_values_KEY])
+                        children[key.id_or_name] = child
+                    child[DS_values_KEY] = __push_onto_values_list(
+                            child.get(DS_values_KEY, []), 
+                            pushes[key.id_or_name])
+                DS.put_multi(list(children.values()) + snapshots)
 
         # retry the Entity update in a transaction until it succeeds
-        transactionWorked = False
-        for _ in range(15):
-            try:
-                with DS.transaction():
-                    dd = DS.get(ddkey)
-
-                    # get a property named for the env var, which is a list of
-                    # dict values
-                    valuesList = dd.get(property_name, [])
-
-                    # put this value at the front of the list
-                    valuesList.insert(0, pydict)
-                    # cap max size of list
-                    while len(valuesList) > DS_env_vars_MAX_size:
-                        valuesList.pop() # remove last item in list
-
-                    # update the entity
-                    dd[property_name] = valuesList 
-
-                    # save the entity to the datastore
-                    dd.exclude_from_indexes = dd.keys()
-                    DS.put(dd)  
-                    transactionWorked = True
-                    break
-            except Exception as e:
-                #logging.debug('save_data_to_Device: transaction failed '\
-                #        '{}'.format( e ))
-                continue
-        if not transactionWorked:
-            logging.error(f'push_dict_onto_device_data_queue: '
+        try:
+            if is_device_data_child_layout():
+                retry.default_policy.call(
+                        'push_dicts_onto_device_data_queues', update_children)
+                __device_data_cache.invalidate(device_ID)
+            else:
+                dd = retry.default_policy.call(
+                        'push_dicts_onto_device_data_queues', update)
+                # update the cache in place with the entity we just saved
+                __device_data_cache.put(device_ID, dd)
+        except Exception as e:
+            __device_data_cache.invalidate(device_ID)
+            logging.error(f'push_dicts_onto_device_data_queues: '
                     f'transaction failed '
-                    f'for device_ID={device_ID} name={property_name}')
+                    f'for device_ID={device_ID} names={list(pushes)}: {e}')
             return False
 
-        logging.debug(f'push_dict_onto_device_data_queue: saved '
-                f'device_ID={device_ID} name={property_name} dict={pydict}')
+        # Status messages are how we know a device is alive.
+        if DS_status_KEY in pushes:
+            update_last_seen_in_DS(device_ID)
+
+        logging.debug(f'push_dicts_onto_device_data_queues: saved '
+                f'device_ID={device_ID} pushes={pushes}')
         return True
 
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
-        logging.critical( "Exception in save_data_to_Device(): %s" % e)
+        logging.critical(f'Exception in push_dicts_onto_device_data_queues(): '
+                f'{e}')
         traceback.print_tb( exc_traceback, file=sys.stdout )
         return False
 
@@ -659,33 +1611,61 @@ def save_list_as_device_data_queue(device_ID: str,
         # These DeviceData entities are custom keyed with our device_ID.
         ddkey = DS.key(DS_device_data_KIND, device_ID)
         dd = DS.get(ddkey) 
-        if not dd: 
+        if dd is None: 
             # The device data entity doesn't exist, so create it 
             # (no transaction needed)
             dd = datastore.Entity(ddkey)
             dd.update({})   # empty entity
             DS.put(dd)      # write to DS
+            increment_entity_counter_in_DS(DS_device_data_KIND)
+
+        # The FleetSnapshot is updated in the same transaction.
+        # (the list is newest first, so its first dict is the latest value)
+        latest = {}
+        if isinstance(pylist, list) and 0 < len(pylist):
+            latest = __get_fleet_snapshot_changes({property_name: pylist[:1]})
+
+        def update():
+            with DS.transaction():
+                entities, snapshots = __get_multi_with_fleet_snapshot(DS, 
+                        device_ID, [ddkey], latest)
+                dd = entities[ddkey]
+                dd[property_name] = pylist 
+                dd.exclude_from_indexes = dd.keys()
+                DS.put_multi([dd] + snapshots)  
+
+        # The whole child entity is replaced, so a transaction is only 
+        # needed for the snapshot.
+        def update_child():
+            child = datastore.Entity(
+                    __get_device_data_property_key(DS, device_ID, 
+                        property_name), 
+                    exclude_from_indexes=[DS_values_KEY])
+            child[DS_values_KEY] = pylist
+            if 0 == len(latest):
+                DS.put(child)
+                return
+            with DS.transaction():
+                _, snapshots = __get_multi_with_fleet_snapshot(DS, 
+                        device_ID, [], latest)
+                DS.put_multi([child] + snapshots)
 
         # retry the Entity update in a transaction until it succeeds
-        transactionWorked = False
-        for _ in range(15):
-            try:
-                with DS.transaction():
-                    dd = DS.get(ddkey)
-                    dd[property_name] = pylist 
-                    dd.exclude_from_indexes = dd.keys()
-                    DS.put(dd)  
-                    transactionWorked = True
-                    break
-            except Exception as e:
-                #logging.debug('save_data_to_Device: transaction failed '\
-                #        '{}'.format( e ))
-                continue
-        if not transactionWorked:
+        try:
+            if is_device_data_child_layout():
+                retry.default_policy.call('save_list_as_device_data_queue', 
+                        update_child)
+            else:
+                retry.default_policy.call('save_list_as_device_data_queue', 
+                        update)
+        except Exception as e:
             logging.error(f'save_list_as_device_data_queue: '
                     f'transaction failed '
-                    f'for device_ID={device_ID} name={property_name}')
+                    f'for device_ID={device_ID} name={property_name}: {e}')
             return False
+        finally:
+            # the caller still has a reference to pylist, so don't cache it
+            __device_data_cache.invalidate(device_ID)
 
         logging.debug(f'save_list_as_device_data_queue: saved '
                 f'device_ID={device_ID} name={property_name} list={pylist}')
@@ -698,6 +1678,80 @@ def save_list_as_device_data_queue(device_ID: str,
         return False
 
 
+#------------------------------------------------------------------------------
+# One shot migration of every DeviceData entity to the child layout: each
+# property is moved to its own DeviceDataProperty child entity and removed 
+# from the parent.  Set DS_DEVICE_DATA_LAYOUT=child on all the services that
+# write DeviceData before running this, readers using the child layout
+# see the parent properties until they are migrated.
+# Returns the number of DeviceData entities migrated.
+def migrate_device_data_to_child_entities_in_DS() -> int:
+    DS = get_client()
+    if DS is None:
+        return 0
+    query = DS.query(kind=DS_device_data_KIND)
+    query.keys_only()
+    keys = [e.key for e in query.fetch()] 
+
+    migrated = 0
+    for ddkey in keys:
+        device_ID = ddkey.id_or_name
+
+        def migrate():
+            with DS.transaction():
+                dd = DS.get(ddkey)
+                if dd is None or 0 == len(dd):
+                    return False # nothing to move
+                child_keys = [__get_device_data_property_key(DS, device_ID, p)
+                        for p in dd.keys()]
+                children = {}
+                for child in DS.get_multi(child_keys):
+                    children[child.key.id_or_name] = child
+                for key in child_keys:
+                    old_values = dd.get(key.id_or_name, [])
+                    child = children.get(key.id_or_name)
+                    if child is None:
+                        child = datastore.Entity(key, 
+                                exclude_from_indexes=[DS_values_KEY])
+                        child[DS_values_KEY] = old_values
+                        children[key.id_or_name] = child
+                    elif __is_values_history(child.get(DS_values_KEY)):
+                        # values pushed since the layout changed go on top
+                        values = device_data_codec.decode(
+                                child.get(DS_values_KEY)) + \
+                                device_data_codec.decode(old_values)
+                        child[DS_values_KEY] = __encode_values_list(
+                                values[:DS_env_vars_MAX_size])
+                    # else: a child saved as a whole list is newer, keep it
+                DS.put_multi(list(children.values()) + 
+                        [datastore.Entity(ddkey)]) # empty parent
+                return True
+
+        try:
+            if retry.default_policy.call(
+                    'migrate_device_data_to_child_entities_in_DS', migrate):
+                migrated += 1
+        except Exception as e:
+            logging.error(f'migrate_device_data_to_child_entities_in_DS: '
+                    f'failed for device_ID={device_ID}: {e}')
+        __device_data_cache.invalidate(device_ID)
+
+    logging.info(f'migrate_device_data_to_child_entities_in_DS: migrated '
+            f'{migrated} of {len(keys)} DeviceData entities.')
+    return migrated
+
+
+#------------------------------------------------------------------------------
+# Private: returns True if the list looks like a pushed env. var. history
+# (timestamped value dicts) rather than a list saved as a whole.
+def __is_values_history(values) -> bool:
+    if device_data_codec.is_packed(values):
+        return True
+    return isinstance(values, list) and 0 < len(values) and \
+            hasattr(values[0], 'get') and \
+            values[0].get('timestamp') is not None
+
+
 #------------------------------------------------------------------------------
 # Save the URL to an image in cloud storage, as an entity in the datastore, 
 # so the UI can fetch it for display / time lapse.
@@ -707,7 +1761,7 @@ def saveImageURL(deviceId, publicURL, cameraName):
         return 
     key = DS.key(DS_images_KIND)
     image = datastore.Entity(key, exclude_from_indexes=[])
-    cd = time.strftime( '%FT%XZ', time.gmtime())
+    cd = utils.utc_timestamp()
     # Don't use a dict, the strings will be assumed to be "blob" and will be
     # shown as base64 in the console.
     # Use the Entity like a dict to get proper strings.
@@ -716,10 +1770,121 @@ def saveImageURL(deviceId, publicURL, cameraName):
     image['camera_name'] = cameraName
     image['creation_date'] = cd
     DS.put(image)  
+    increment_entity_counter_in_DS(DS_images_KIND)
+
+    # Keep the latest image pointer (upsert) and FleetSnapshot of this
+    # device up to date, in one transaction.
+    pointer = __get_latest_image_pointer(DS, deviceId, image)
+
+    def update():
+        with DS.transaction():
+            _, snapshots = __get_multi_with_fleet_snapshot(DS, deviceId, 
+                    [], {}, publicURL)
+            DS.put_multi([pointer] + snapshots)
+
+    try:
+        retry.default_policy.call('saveImageURL', update)
+    except Exception as e:
+        logging.error(f'saveImageURL: pointer and snapshot update failed '
+                f'for device_ID={deviceId}: {e}')
     logging.info("datastore.saveImageURL: saved {}".format( image ))
     return 
 
 
+#------------------------------------------------------------------------------
+# Save a record of an image that a device is uploading, so it can be
+# finalized (moved and its URL saved) when the file is in the upload bucket.
+# Returns True for success or False for error.
+def save_pending_image_upload_in_DS(device_ID: str, file_name: str,
+        camera_name: str) -> bool:
+    DS = get_client()
+    if DS is None:
+        return False
+    key = DS.key(DS_pending_upload_KIND, file_name)
+    pending = datastore.Entity(key, exclude_from_indexes=[DS_camera_name_KEY])
+    pending[DS_device_uuid_KEY] = device_ID
+    pending[DS_camera_name_KEY] = camera_name
+    pending[DS_created_epoch_KEY] = int(time.time())
+    DS.put(pending)
+    return True
+
+
+#------------------------------------------------------------------------------
+# Returns the pending image upload entity of a file, or None.
+def get_pending_image_upload_from_DS(file_name: str) -> Any:
+    return get_by_key_from_DS(DS_pending_upload_KIND, file_name)
+
+
+#------------------------------------------------------------------------------
+# Returns a list of up to 'limit' pending image upload entities (the file
+# name is the key name), oldest first.
+def get_pending_image_uploads_from_DS(limit: int = DS_query_PAGE_size) -> List:
+    DS = get_client()
+    if DS is None:
+        return []
+    query = DS.query(kind=DS_pending_upload_KIND, 
+            order=[DS_created_epoch_KEY])
+    return list(query.fetch(limit=limit))
+
+
+#------------------------------------------------------------------------------
+# Delete the pending image upload records of some files.
+def delete_pending_image_uploads_from_DS(file_names: List[str]) -> None:
+    DS = get_client()
+    if DS is None:
+        return
+    keys = [DS.key(DS_pending_upload_KIND, name) for name in file_names]
+    for i in range(0, len(keys), DS_delete_multi_MAX_keys):
+        DS.delete_multi(keys[i:i + DS_delete_multi_MAX_keys])
+
 
+#------------------------------------------------------------------------------
+# Pending upload garbage collection, run this periodically (not on a read 
+# path), so records that are never finalized don't pile up when there is
+# no poller to expire them.
+# Returns the number of records deleted.
+def delete_stale_pending_image_uploads_from_DS(max_age_seconds: float) -> int:
+    DS = get_client()
+    if DS is None:
+        return 0
+    query = DS.query(kind=DS_pending_upload_KIND)
+    query.add_filter(DS_created_epoch_KEY, '<', 
+            int(time.time() - max_age_seconds))
+    query.keys_only() # retuns less data, so faster
+    names = [e.key.id_or_name for e in iter_query_from_DS(query)]
+    delete_pending_image_uploads_from_DS(names)
+    if 0 < len(names):
+        logging.info(f'datastore.delete_stale_pending_image_uploads_from_DS:'
+                f' deleted {len(names)} records.')
+    return len(names)
 
 
+#------------------------------------------------------------------------------
+# Take a named lease for some seconds, so only one process (of any service)
+# does some periodic work.  The lease is not released, it just expires.
+# Returns True if we have the lease, False if another process has it (or 
+# for error).
+def acquire_lease_in_DS(name: str, seconds: float) -> bool:
+    DS = get_client()
+    if DS is None:
+        return False
+    key = DS.key(DS_lease_KIND, name)
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    try:
+        with DS.transaction():
+            lease = DS.get(key)
+            now = time.time()
+            if lease is not None and \
+                    lease.get(DS_lease_owner_KEY) != owner and \
+                    lease.get(DS_lease_expires_KEY, 0) > now:
+                return False
+            lease = datastore.Entity(key, exclude_from_indexes=[
+                DS_lease_owner_KEY, DS_lease_expires_KEY])
+            lease[DS_lease_owner_KEY] = owner
+            lease[DS_lease_expires_KEY] = now + seconds
+            DS.put(lease)
+        return True
+    except Exception as e:
+        # contention means another process is taking it
+        logging.info(f'acquire_lease_in_DS: {name} not acquired: {e}')
+        return False
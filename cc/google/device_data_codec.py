@@ -0,0 +1,298 @@
+# Compact packed encoding of the DeviceData value histories.
+
+""" DeviceData value history codec.
+    - The histories are stored as lists of up to DS_env_vars_MAX_size
+      dicts of {'timestamp': str, 'name': str, 'value': str}, newest first.
+    - When enabled (DS_DEVICE_DATA_ENCODING=packed), they are stored instead
+      as one blob property:
+        numeric series: b'CCN1', count, name, then (epoch secs, float32) pairs.
+        string series:  b'CCS1', count, then (epoch secs, length prefixed
+                        name, length prefixed value) records.
+      A series is only numeric if each value string comes back exactly from
+      its float32, else it is a string series.  Lists that can't be packed
+      at all (e.g. timestamps before 1970) are stored as lists.
+    - Readers use DeviceDataSeries, which reads either form and only decodes
+      what is asked for (NumPy arrays are built on first use).
+"""
+
+import struct
+
+from typing import Any, Dict, List, Tuple
+
+from cloud_common.cc import utils
+
+
+# Encodings (set with the DS_DEVICE_DATA_ENCODING env. var.)
+ENCODING_LIST = 'list'     # list of dicts (the original form)
+ENCODING_PACKED = 'packed' # one packed blob per property
+
+NUMERIC_MAGIC = b'CCN1'
+STRING_MAGIC = b'CCS1'
+
+TIMESTAMP_FORMAT = utils.TIMESTAMP_FORMAT
+
+# The only keys a history dict can have to be packed.
+# (the optional 'epoch' is the timestamp as epoch secs, so it isn't stored)
+PACKABLE_KEYS = frozenset(['timestamp', 'name', 'value', 'epoch'])
+
+COUNT_STRUCT = struct.Struct('<I')
+LENGTH_STRUCT = struct.Struct('<H')
+NUMERIC_RECORD_STRUCT = struct.Struct('<If') # epoch secs, value
+STRING_RECORD_STRUCT = struct.Struct('<IHI') # epoch secs, name len, value len
+FLOAT_STRUCT = struct.Struct('<f')
+
+
+#------------------------------------------------------------------------------
+# Returns True if the stored property value is one of our packed blobs.
+def is_packed(stored: Any) -> bool:
+    return isinstance(stored, bytes) and \
+            (stored.startswith(NUMERIC_MAGIC) or \
+             stored.startswith(STRING_MAGIC))
+
+
+#------------------------------------------------------------------------------
+def timestamp_to_epoch(ts: str) -> int:
+    return utils.timestamp_to_epoch(ts)
+
+
+#------------------------------------------------------------------------------
+def epoch_to_timestamp(epoch: int) -> str:
+    return utils.utc_timestamp(epoch)
+
+
+#------------------------------------------------------------------------------
+# Encode a list of history dicts (newest first) as a packed blob.
+# Returns the blob, or None if the list can't be packed (then store the list).
+def encode(values_list: List[Dict]) -> Any:
+    if not isinstance(values_list, list) or 0 == len(values_list):
+        return None
+    records = []
+    for d in values_list:
+        if not hasattr(d, 'keys') or not set(d.keys()) <= PACKABLE_KEYS:
+            return None
+        try:
+            epoch = timestamp_to_epoch(
+                    utils.bytes_to_string(d.get('timestamp')))
+        except Exception:
+            return None
+        records.append((epoch,
+            str(utils.bytes_to_string(d.get('name', ''))),
+            str(utils.bytes_to_string(d.get('value', '')))))
+
+    try:
+        return __pack(records)
+    except (struct.error, OverflowError):
+        # e.g. a timestamp before 1970, or a name over 64KB
+        return None
+
+
+#------------------------------------------------------------------------------
+# Private: returns True if a value string is a float that the numeric series 
+# gives back exactly (as a float32, rendered as '{:.7g}').
+def __is_float32_exact(value: str) -> bool:
+    try:
+        f = FLOAT_STRUCT.unpack(FLOAT_STRUCT.pack(float(value)))[0]
+    except (ValueError, OverflowError):
+        return False
+    return '{:.7g}'.format(f) == value
+
+
+#------------------------------------------------------------------------------
+# Private: pack (epoch, name, value) records as a blob.
+def __pack(records: List[Tuple[int, str, str]]) -> bytes:
+    # One name and all exact float values is a numeric series, anything else
+    # is a string series (which keeps the strings as they are).
+    names = set([r[1] for r in records])
+    if 1 == len(names) and all([__is_float32_exact(r[2]) for r in records]):
+        name = names.pop().encode('utf-8')
+        blob = [NUMERIC_MAGIC, COUNT_STRUCT.pack(len(records)),
+                LENGTH_STRUCT.pack(len(name)), name]
+        for r in records:
+            blob.append(NUMERIC_RECORD_STRUCT.pack(r[0], float(r[2])))
+        return b''.join(blob)
+
+    blob = [STRING_MAGIC, COUNT_STRUCT.pack(len(records))]
+    for epoch, name, value in records:
+        name = name.encode('utf-8')
+        value = value.encode('utf-8')
+        blob.append(STRING_RECORD_STRUCT.pack(epoch, len(name), len(value)))
+        blob.append(name)
+        blob.append(value)
+    return b''.join(blob)
+
+
+#------------------------------------------------------------------------------
+# Returns the list of history dicts for a stored property value, in either
+# form.  (The compatibility reader for code that wants the list of dicts.)
+def decode(stored: Any) -> List[Dict]:
+    return DeviceDataSeries(stored).to_list()
+
+
+class DeviceDataSeries:
+    """ A lazily decoded DeviceData value history, newest first.
+        Works with a packed blob or the original list of dicts.
+    """
+
+    #--------------------------------------------------------------------------
+    def __init__(self, stored: Any) -> None:
+        self.__stored = stored
+        self.__records = None # list of (epoch, name, value str)
+        self.__numeric = stored is not None and \
+                isinstance(stored, bytes) and stored.startswith(NUMERIC_MAGIC)
+        self.__timestamps = None
+        self.__values = None
+
+
+    #--------------------------------------------------------------------------
+    def __len__(self) -> int:
+        if is_packed(self.__stored):
+            return COUNT_STRUCT.unpack_from(self.__stored, 
+                    len(NUMERIC_MAGIC))[0]
+        if isinstance(self.__stored, list):
+            return len(self.__stored)
+        return 0
+
+
+    #--------------------------------------------------------------------------
+    # True if the values are all numbers (a packed numeric series).
+    def is_numeric(self) -> bool:
+        return self.__numeric
+
+
+    #--------------------------------------------------------------------------
+    # Returns the latest (value, timestamp) strings, or ('', '') for empty.
+    # Only decodes the first record.
+    def latest(self) -> Tuple[str, str]:
+        if 0 == len(self):
+            return '', ''
+        if not is_packed(self.__stored):
+            d = self.__stored[0]
+            return utils.bytes_to_string(d.get('value', b'')), \
+                    utils.bytes_to_string(d.get('timestamp', b''))
+        epoch, name, value = self.__decode_records(1)[0]
+        return value, epoch_to_timestamp(epoch)
+
+
+    #--------------------------------------------------------------------------
+    # Returns the epoch secs of the latest value, or None for empty.
+    # Uses the stored 'epoch' if the dict has one, instead of parsing.
+    def latest_epoch(self) -> Any:
+        if 0 == len(self):
+            return None
+        if not is_packed(self.__stored):
+            d = self.__stored[0]
+            if 'epoch' in d:
+                return int(d['epoch'])
+            try:
+                return timestamp_to_epoch(
+                        utils.bytes_to_string(d.get('timestamp', '')))
+            except ValueError:
+                return None
+        return self.__decode_records(1)[0][0]
+
+
+    #--------------------------------------------------------------------------
+    # Returns the list of history dicts (newest first).
+    def to_list(self) -> List[Dict]:
+        if self.__stored is None:
+            return []
+        if not is_packed(self.__stored):
+            return self.__stored
+        return [{'timestamp': epoch_to_timestamp(epoch),
+                 'name': name, 'value': value}
+                for epoch, name, value in self.__get_records()]
+
+
+    #--------------------------------------------------------------------------
+    # NumPy array of the epoch seconds of each value.
+    @property
+    def timestamps(self) -> Any:
+        if self.__timestamps is None:
+            import numpy as np
+            if self.__numeric:
+                self.__timestamps, self.__values = self.__decode_numeric()
+            else:
+                self.__timestamps = np.array(
+                        [r[0] for r in self.__get_records()], dtype=np.int64)
+        return self.__timestamps
+
+
+    #--------------------------------------------------------------------------
+    # NumPy array of the values, float32 for a numeric series or else str.
+    @property
+    def values(self) -> Any:
+        if self.__values is None:
+            import numpy as np
+            if self.__numeric:
+                self.__timestamps, self.__values = self.__decode_numeric()
+            else:
+                self.__values = np.array(
+                        [r[2] for r in self.__get_records()], dtype=object)
+        return self.__values
+
+
+    #--------------------------------------------------------------------------
+    # Private: all the records as (epoch, name, value str) tuples.
+    def __get_records(self) -> List[Tuple[int, str, str]]:
+        if self.__records is None:
+            if is_packed(self.__stored):
+                self.__records = self.__decode_records(len(self))
+            else:
+                self.__records = self.__list_records()
+        return self.__records
+
+
+    #--------------------------------------------------------------------------
+    # Private: records from the original list of dicts form.
+    def __list_records(self) -> List[Tuple[int, str, str]]:
+        records = []
+        for d in self.__stored or []:
+            ts = utils.bytes_to_string(d.get('timestamp', ''))
+            try:
+                epoch = timestamp_to_epoch(ts)
+            except Exception:
+                epoch = 0
+            records.append((epoch,
+                str(utils.bytes_to_string(d.get('name', ''))),
+                str(utils.bytes_to_string(d.get('value', '')))))
+        return records
+
+
+    #--------------------------------------------------------------------------
+    # Private: decode the first 'count' records of a packed blob.
+    def __decode_records(self, count: int) -> List[Tuple[int, str, str]]:
+        blob = self.__stored
+        offset = len(NUMERIC_MAGIC) + COUNT_STRUCT.size
+        records = []
+        if self.__numeric:
+            name_len = LENGTH_STRUCT.unpack_from(blob, offset)[0]
+            offset += LENGTH_STRUCT.size
+            name = blob[offset:offset + name_len].decode('utf-8')
+            offset += name_len
+            for epoch, value in NUMERIC_RECORD_STRUCT.iter_unpack(
+                    blob[offset:offset + count * NUMERIC_RECORD_STRUCT.size]):
+                records.append((epoch, name, '{:.7g}'.format(value)))
+            return records
+        for _ in range(count):
+            epoch, name_len, value_len = \
+                    STRING_RECORD_STRUCT.unpack_from(blob, offset)
+            offset += STRING_RECORD_STRUCT.size
+            name = blob[offset:offset + name_len].decode('utf-8')
+            offset += name_len
+            value = blob[offset:offset + value_len].decode('utf-8')
+            offset += value_len
+            records.append((epoch, name, value))
+        return records
+
+
+    #--------------------------------------------------------------------------
+    # Private: decode a packed numeric series straight into NumPy arrays.
+    def __decode_numeric(self) -> Tuple[Any, Any]:
+        import numpy as np
+        blob = self.__stored
+        offset = len(NUMERIC_MAGIC) + COUNT_STRUCT.size
+        offset += LENGTH_STRUCT.size + LENGTH_STRUCT.unpack_from(blob, offset)[0]
+        pairs = np.frombuffer(blob, offset=offset, count=len(self),
+                dtype=np.dtype([('epoch', '<u4'), ('value', '<f4')]))
+        return pairs['epoch'].astype(np.int64), pairs['value'].copy()
+
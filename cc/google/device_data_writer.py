@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+""" Device Data Writer class.
+    - Opt in, write coalescing buffer in front of
+      datastore.push_dicts_onto_device_data_queues().
+    - Devices send their env. vars in bursts, so instead of reading and
+      rewriting the same DeviceData entity once per variable, pushes are
+      buffered per device and property for a short window (or until a count
+      threshold is reached) and then applied in one transaction per device.
+    - The writes of a device are done one at a time, in push order, by 
+      whichever thread started them (other threads queue theirs and return).
+    - Call flush() before the process exits.
+"""
+
+import logging, threading
+
+from typing import Dict, List
+
+from cloud_common.cc.google import datastore
+
+
+class DeviceDataWriter:
+
+    # For logging
+    name: str = 'cloud_common.cc.google.device_data_writer'
+
+
+    #--------------------------------------------------------------------------
+    # window_seconds: the longest a push waits in the buffer.
+    # max_pending: a device is written right away when it has this many
+    #              pushes buffered.
+    def __init__(self, window_seconds: float = 1.0,
+            max_pending: int = 50) -> None:
+        self.window_seconds = window_seconds
+        self.max_pending = max_pending
+        self.__pending = {} # device_ID: {property_name: [dicts, oldest first]}
+        self.__pending_counts = {} # device_ID: number of buffered pushes
+        self.__queued = {} # device_ID: [pushes to write, oldest first]
+        self.__lock = threading.Lock()
+        self.__written = threading.Condition(self.__lock)
+        self.__timer = None
+
+
+    #--------------------------------------------------------------------------
+    # Buffer a dict to push onto a DeviceData property queue.
+    def push(self, device_ID: str, property_name: str, pydict: Dict) -> None:
+        write = False
+        with self.__lock:
+            properties = self.__pending.setdefault(device_ID, {})
+            properties.setdefault(property_name, []).append(pydict)
+            count = self.__pending_counts.get(device_ID, 0) + 1
+            self.__pending_counts[device_ID] = count
+            if count >= self.max_pending:
+                # this device has enough for a write, so do it now
+                write = self.__queue(device_ID, self.__pending.pop(device_ID))
+                del self.__pending_counts[device_ID]
+            elif self.__timer is None:
+                self.__timer = threading.Timer(self.window_seconds,
+                        self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+        if write:
+            self.__write_queued(device_ID)
+
+
+    #--------------------------------------------------------------------------
+    # Write everything that is buffered, and wait for it.
+    # Returns the number of devices written.
+    def flush(self) -> int:
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = {}
+            self.__pending_counts = {}
+            if self.__timer is not None:
+                self.__timer.cancel() # harmless if we are the timer thread
+                self.__timer = None
+            writes = [device_ID for device_ID, pushes in pending.items()
+                    if self.__queue(device_ID, pushes)]
+            queued = list(self.__queued)
+        for device_ID in writes:
+            self.__write_queued(device_ID)
+        with self.__lock: # other threads may still be writing some devices
+            self.__written.wait_for(lambda: not any(
+                [device_ID in self.__queued for device_ID in queued]))
+        return len(pending)
+
+
+    #--------------------------------------------------------------------------
+    # Private: queue the pushes of a device to write.  Call with the lock 
+    # held.  Returns True if the caller must write the queue (no other thread
+    # is writing this device).
+    def __queue(self, device_ID: str, pushes: Dict[str, List[Dict]]) -> bool:
+        queued = self.__queued.get(device_ID)
+        if queued is not None:
+            queued.append(pushes) # the writing thread will get to it
+            return False
+        self.__queued[device_ID] = [pushes]
+        return True
+
+
+    #--------------------------------------------------------------------------
+    # Private: write the queued pushes of a device, in order, until there are
+    # none left.
+    def __write_queued(self, device_ID: str) -> None:
+        while True:
+            with self.__lock:
+                queued = self.__queued[device_ID]
+                if 0 == len(queued):
+                    del self.__queued[device_ID]
+                    self.__written.notify_all()
+                    return
+                pushes = queued.pop(0)
+            self.__write(device_ID, pushes)
+
+
+    #--------------------------------------------------------------------------
+    # Private: one transaction for all the pushes of one device.
+    def __write(self, device_ID: str, pushes: Dict[str, List[Dict]]) -> None:
+        try:
+            if not datastore.push_dicts_onto_device_data_queues(device_ID,
+                    pushes):
+                logging.error(f'{self.name}.__write: failed for '
+                        f'device_ID={device_ID} names={list(pushes)}')
+        except Exception as e:
+            logging.critical(f'Exception in {self.name}.__write(): '
+                    f'device_ID={device_ID} {e}')
+
+
@@ -18,5 +18,30 @@ bq_table = os.getenv('BQ_TABLE')
 cs_bucket = os.getenv('CS_BUCKET')
 cs_upload_bucket = os.getenv('CS_UPLOAD_BUCKET')
 
+# How DeviceData is stored: 'entity' (default) or 'child', see datastore.py
+device_data_layout = os.getenv('DS_DEVICE_DATA_LAYOUT', 'entity')
 
+# How DeviceData histories are encoded: 'list' (default) or 'packed', 
+# see device_data_codec.py
+device_data_encoding = os.getenv('DS_DEVICE_DATA_ENCODING', 'list')
 
+# Set to 'true' to also store the integer epoch seconds in each DeviceData 
+# value dict (as 'epoch'), so readers don't have to parse the timestamp.
+device_data_epoch = os.getenv('DS_DEVICE_DATA_EPOCH', 'false')
+
+# Set to 'true' to fetch the IoT API discovery document when the client is 
+# made, instead of using our copy in cc/google/discovery/
+iot_discovery_refresh = os.getenv('IOT_DISCOVERY_REFRESH', 'false')
+
+# Optional IoT API root URL, e.g. 'http://localhost:8085/' for a local 
+# stand-in server when testing.
+iot_api_root_url = os.getenv('IOT_API_ROOT_URL')
+
+# The least seconds between runs of the upload bucket janitor (which deletes
+# stale uploaded files), see storage_janitor.py
+storage_janitor_interval_secs = os.getenv('STORAGE_JANITOR_INTERVAL_SECS', 
+        '600')
+
+# Optional comma separated file name prefixes the upload bucket janitor
+# lists (e.g. 'EDU-,AMF-'), instead of the whole bucket.
+storage_janitor_prefixes = os.getenv('STORAGE_JANITOR_PREFIXES', '')
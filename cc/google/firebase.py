@@ -10,25 +10,46 @@ import time
 import traceback
 from datetime import datetime
 
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+from typing import Any
 
+from cloud_common.cc import utils
+from cloud_common.cc.google import clients
 from cloud_common.cc.google import env_vars
 
+# Loaded on first use, they are slow to import.
+firebase_admin = utils.lazy_import('firebase_admin')
+credentials = utils.lazy_import('firebase_admin.credentials')
+firestore = utils.lazy_import('firebase_admin.firestore')
+
 
 #------------------------------------------------------------------------------
 # Returns an authorized API client by discovering the IoT API
 # using the service account credentials JSON.
 def get_firestore_client(fb_service_account_json):
-    cred = credentials.Certificate(fb_service_account_json)
-    firebase_admin.initialize_app(cred)
+    try:
+        firebase_admin.get_app() # only initialize the app once per process
+    except ValueError:
+        cred = credentials.Certificate(fb_service_account_json)
+        firebase_admin.initialize_app(cred)
     return firestore.client()
 
 
 #------------------------------------------------------------------------------
-# Get a firebase client using the firebase auth
-fs_client = get_firestore_client(env_vars.path_to_firebase_service_account)
+# Returns the shared (per process) firebase client using the firebase auth.
+def get_client() -> Any:
+    return clients.get_client(clients.FIRESTORE)
+
+
+#------------------------------------------------------------------------------
+# The old fs_client module global, now made on first use.
+def __getattr__(name: str) -> Any:
+    if 'fs_client' == name:
+        return get_client()
+    raise AttributeError(f'module {__name__} has no attribute {name}')
+
+
+clients.register(clients.FIRESTORE, 
+        lambda: get_firestore_client(env_vars.path_to_firebase_service_account))
 
 
 #------------------------------------------------------------------------------
@@ -37,7 +58,7 @@ def get_firebase_device_reg_stats():
 
     # get a firestore DB collection of the RSA public keys uploaded by
     # a setup script on the device:
-    keys_ref = fs_client.collection(u'devicePublicKeys')
+    keys_ref = get_client().collection(u'devicePublicKeys')
 
     # snaps = keys_ref.get()  # get snapshots (partial data) of all docs
     # for snap in snaps:
@@ -85,7 +106,7 @@ def delete_firestore_keys(key_type):
     if key_type != u'verified' and key_type != u'unclaimed':
         return {}
 
-    keys_ref = fs_client.collection(u'devicePublicKeys')
+    keys_ref = get_client().collection(u'devicePublicKeys')
     query = keys_ref.where(u'state', u'==', key_type)
     doc_snapshots = query.get() # get partial data document snapshots
 
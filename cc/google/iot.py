@@ -1,37 +1,84 @@
 # https://cloud.google.com/iot/docs/samples/device-manager-samples
 
-import datetime as dt
-from google.oauth2 import service_account
-from googleapiclient import discovery, errors
+import json, logging, os, urllib.request
 
+from typing import Any, Dict
+
+from cloud_common.cc import utils
+from cloud_common.cc.google import clients
 from cloud_common.cc.google import env_vars
 
+# Loaded on first use, they are slow to import.
+service_account = utils.lazy_import('google.oauth2.service_account')
+discovery = utils.lazy_import('googleapiclient.discovery')
+errors = utils.lazy_import('googleapiclient.errors')
+httplib2 = utils.lazy_import('httplib2')
+
+# Our copy of the IoT API discovery document (trimmed to the methods we use),
+# so making a client doesn't need a network round trip.
+DISCOVERY_DOC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'discovery', 'cloudiot_v1.json')
+DISCOVERY_URL = 'https://cloudiot.googleapis.com/$discovery/rest?version=v1'
+
+
+# ------------------------------------------------------------------------------
+# Returns the IoT API discovery document dict.  Our copy, unless the
+# IOT_DISCOVERY_REFRESH env. var. is 'true', then it is fetched (and if that
+# fails, our copy is used).
+def get_discovery_document() -> Dict:
+    if 'true' == env_vars.iot_discovery_refresh:
+        try:
+            with urllib.request.urlopen(DISCOVERY_URL, timeout=10) as res:
+                return json.loads(res.read().decode('utf-8'))
+        except Exception as e:
+            logging.error(f'iot.get_discovery_document: fetching '
+                    f'{DISCOVERY_URL} failed, using our copy: {e}')
+    with open(DISCOVERY_DOC_PATH) as f:
+        return json.load(f)
+
 
 # ------------------------------------------------------------------------------
-# Returns an authorized API client by discovering the IoT API
-# using the service account credentials JSON file.
+# Returns an authorized API client for the IoT API, built from the discovery
+# document, using the service account credentials JSON file.
+# If the IOT_API_ROOT_URL env. var. is set, the client talks to that server
+# instead (and with no credentials file, makes unauthenticated requests).
 def get_IoT_client(path_to_service_account_json):
     api_scopes = ['https://www.googleapis.com/auth/cloud-platform']
-    api_version = 'v1'
-    discovery_api = 'https://cloudiot.googleapis.com/$discovery/rest'
-    service_name = 'cloudiotcore'
+
+    doc = get_discovery_document()
+    root_URL = env_vars.iot_api_root_url
+    if root_URL:
+        doc['rootUrl'] = root_URL
+        doc['baseUrl'] = root_URL + doc.get('servicePath', '')
+        if path_to_service_account_json is None:
+            # e.g. a local stand-in server for testing
+            return discovery.build_from_document(doc, http=httplib2.Http())
 
     creds = service_account.Credentials.from_service_account_file(
         path_to_service_account_json)
     scoped_credentials = creds.with_scopes(api_scopes)
 
-    discovery_url = '{}?version={}'.format(
-        discovery_api, api_version)
+    return discovery.build_from_document(doc, 
+            credentials=scoped_credentials)
+
+
+#------------------------------------------------------------------------------
+# Returns the shared (per process) IoT client, 
+# using the GCP project (NOT firebase proj!)
+def get_client() -> Any:
+    return clients.get_client(clients.IOT)
+
 
-    return discovery.build(
-        service_name,
-        api_version,
-        discoveryServiceUrl=discovery_url,
-        credentials=scoped_credentials)
+#------------------------------------------------------------------------------
+# The old iot_client module global, now made on first use.
+def __getattr__(name: str) -> Any:
+    if 'iot_client' == name:
+        return get_client()
+    raise AttributeError(f'module {__name__} has no attribute {name}')
 
 
-# Get an IoT client using the GCP project (NOT firebase proj!)
-iot_client = get_IoT_client(env_vars.path_to_google_service_account)
+clients.register(clients.IOT, 
+        lambda: get_IoT_client(env_vars.path_to_google_service_account))
 
 
 #------------------------------------------------------------------------------
@@ -44,7 +91,7 @@ def get_iot_registrations():
 
     try:
         # get devices registry and list
-        devices = iot_client.projects().locations().registries().devices()
+        devices = get_client().projects().locations().registries().devices()
         list_of_devices = devices.list(parent=registry_name).execute(
                 ).get('devices', [])
     except errors.HttpError as e:
@@ -54,7 +101,7 @@ def get_iot_registrations():
 
     res = {}
     res['registered'] = "{:,}".format(len(list_of_devices))
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
@@ -68,7 +115,7 @@ def get_iot_device_list():
 
     try:
         # get devices registry and list
-        devices = iot_client.projects().locations().registries().devices()
+        devices = get_client().projects().locations().registries().devices()
         list_of_devices = devices.list(parent=registry_name).execute(
                 ).get('devices', [])
     except errors.HttpError as e:
@@ -104,7 +151,7 @@ def get_iot_device_list():
 
         res['devices'].append(dev)
 
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
@@ -119,7 +166,7 @@ def delete_iot_device(device_id):
 
     try:
         # get devices registry 
-        devices = iot_client.projects().locations().registries().devices()
+        devices = get_client().projects().locations().registries().devices()
         devices.delete(name=device_name).execute()
         return True
     except errors.HttpError as e:
@@ -4,28 +4,25 @@ https://google-cloud-python.readthedocs.io/en/stable/pubsub/
 
 import logging, json
 
-from google.cloud import pubsub
-
 from typing import Dict, Callable
 
+from cloud_common.cc import utils
+from cloud_common.cc.google import clients
 
-# Globals
-__subs_client = None
-__pubs_client = None
+# Loaded on first use, it takes seconds to import.
+pubsub = utils.lazy_import('google.cloud.pubsub')
 
 
 #------------------------------------------------------------------------------
 # Clients for google cloud pubsub.
 # This takes 15 seconds or so to happen.
 def create_clients() -> None:
-    global __subs_client
-    global __pubs_client 
+    clients.get_client(clients.PUBSUB_SUBSCRIBER)
+    clients.get_client(clients.PUBSUB_PUBLISHER)
 
-    if __subs_client is None:
-        __subs_client = pubsub.SubscriberClient()
 
-    if __pubs_client is None:
-        __pubs_client = pubsub.PublisherClient()
+clients.register(clients.PUBSUB_SUBSCRIBER, lambda: pubsub.SubscriberClient())
+clients.register(clients.PUBSUB_PUBLISHER, lambda: pubsub.PublisherClient())
 
 
 #------------------------------------------------------------------------------
@@ -39,11 +36,10 @@ def create_clients() -> None:
 def subscribe(project: str, subscription: str, callback: Callable) -> None:
 
     # on demand client creation
-    global __subs_client
-    create_clients()
+    subs_client = clients.get_client(clients.PUBSUB_SUBSCRIBER)
 
     # create our gcloud project + subscription path
-    subs_path = __subs_client.subscription_path(project, subscription)
+    subs_path = subs_client.subscription_path(project, subscription)
 
     # subscribe for messages
     logging.info(f'Waiting for message sent to {subs_path}')
@@ -51,7 +47,7 @@ def subscribe(project: str, subscription: str, callback: Callable) -> None:
     # in case of subscription timeout, use a loop to resubscribe.
     while True:  
         try:
-            future = __subs_client.subscribe(subs_path, callback)
+            future = subs_client.subscribe(subs_path, callback)
 
             # result() blocks until future is complete 
             # (when message is ack'd by server)
@@ -71,13 +67,12 @@ def subscribe(project: str, subscription: str, callback: Callable) -> None:
 def publish(project: str, topic: str, message: Dict) -> None:
     try:
         # on demand client creation
-        global __pubs_client 
-        create_clients()
+        pubs_client = clients.get_client(clients.PUBSUB_PUBLISHER)
 
         message_json = json.dumps(message)
         path = f'projects/{project}/topics/{topic}'
         logging.debug(f'publishing: {message_json} to {path}')
-        __pubs_client.publish(path, message_json.encode('utf-8'))
+        pubs_client.publish(path, message_json.encode('utf-8'))
 
     except Exception as e:
         logging.error(f'cloud_common.cc.google.pubsub.publish: {e}')
@@ -0,0 +1,144 @@
+# https://googleapis.dev/python/google-api-core/latest/exceptions.html
+
+""" Shared retry policy for contended google cloud calls (transactions).
+    - Exponential backoff with full jitter.
+    - Only retries retryable (contention / aborted / unavailable) errors.
+    - Gives up after max_attempts or max_elapsed_seconds.
+    - Keeps per call site counters so we can see hot entities.
+"""
+
+import logging, random, threading, time
+
+from typing import Any, Callable, Dict
+
+from cloud_common.cc import utils
+
+# Loaded on first use (it imports grpc).
+exceptions = utils.lazy_import('google.api_core.exceptions')
+
+
+# Names of the google.api_core.exceptions worth retrying, everything else is
+# raised right away.
+RETRYABLE_EXCEPTIONS = (
+    'Aborted',            # transaction contention
+    'Conflict',           # too much contention on these entities
+    'ServiceUnavailable', # transient
+)
+
+# Globals
+__stats_lock = threading.Lock()
+__stats = {} # call site name: dict of counters
+
+
+#------------------------------------------------------------------------------
+# Returns True if the exception is worth retrying.
+def is_retryable(e: Exception) -> bool:
+    return isinstance(e, 
+            tuple([getattr(exceptions, name) for name in RETRYABLE_EXCEPTIONS]))
+
+
+#------------------------------------------------------------------------------
+# Add to the counters of a call site.
+def record_call_stats(site: str, attempts: int, aborts: int, failed: bool,
+        retry_seconds: float) -> None:
+    with __stats_lock:
+        s = __stats.setdefault(site, {'calls': 0, 'attempts': 0,
+            'aborts': 0, 'failures': 0, 'retry_seconds': 0.0})
+        s['calls'] += 1
+        s['attempts'] += attempts
+        s['aborts'] += aborts
+        s['retry_seconds'] += retry_seconds
+        if failed:
+            s['failures'] += 1
+
+
+#------------------------------------------------------------------------------
+# Returns a dict of call site name to a dict of counters:
+#   calls, attempts, aborts (retryable errors), failures (gave up or
+#   not retryable), retry_seconds (time spent after the first failure).
+def get_retry_stats() -> Dict[str, Dict[str, Any]]:
+    with __stats_lock:
+        return {site: dict(s) for site, s in __stats.items()}
+
+
+#------------------------------------------------------------------------------
+def reset_retry_stats() -> None:
+    with __stats_lock:
+        __stats.clear()
+
+
+class RetryPolicy:
+
+    # For logging
+    name: str = 'cloud_common.cc.google.retry'
+
+
+    #--------------------------------------------------------------------------
+    def __init__(self, initial_delay: float = 0.05, max_delay: float = 2.0,
+            multiplier: float = 2.0, max_attempts: int = 15,
+            max_elapsed_seconds: float = 10.0) -> None:
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.max_attempts = max_attempts
+        self.max_elapsed_seconds = max_elapsed_seconds
+
+
+    #--------------------------------------------------------------------------
+    # Returns the (jittered) seconds to sleep before retry number 'retry'.
+    def get_delay(self, retry: int) -> float:
+        delay = min(self.max_delay,
+                self.initial_delay * (self.multiplier ** retry))
+        return random.uniform(0, delay) # full jitter
+
+
+    #--------------------------------------------------------------------------
+    # Call func() until it works, retrying only retryable errors.
+    # Args:
+    #   site: the call site name the counters are kept under.
+    #   func: function with no args, e.g. a closure that runs a transaction.
+    # Returns what func returns, or raises the last exception.
+    def call(self, site: str, func: Callable) -> Any:
+        start = time.monotonic()
+        first_failure = None
+        attempts = 0
+        aborts = 0
+        while True:
+            attempts += 1
+            try:
+                result = func()
+                record_call_stats(site, attempts, aborts, False,
+                        self.__retry_seconds(first_failure))
+                return result
+            except Exception as e:
+                if first_failure is None:
+                    first_failure = time.monotonic()
+                retryable = is_retryable(e)
+                if retryable:
+                    aborts += 1
+                elapsed = time.monotonic() - start
+                if not retryable or attempts >= self.max_attempts or \
+                        elapsed >= self.max_elapsed_seconds:
+                    record_call_stats(site, attempts, aborts, True,
+                            self.__retry_seconds(first_failure))
+                    logging.error(f'{self.name}: {site} failed after '
+                            f'{attempts} attempts in {elapsed:.2f} secs: {e}')
+                    raise
+                delay = self.get_delay(attempts - 1)
+                delay = min(delay, self.max_elapsed_seconds - elapsed)
+                logging.debug(f'{self.name}: {site} retry {attempts} in '
+                        f'{delay:.3f} secs: {e}')
+                time.sleep(delay)
+
+
+    #--------------------------------------------------------------------------
+    # Private: seconds since the first failure (or zero).
+    def __retry_seconds(self, first_failure: Any) -> float:
+        if first_failure is None:
+            return 0.0
+        return time.monotonic() - first_failure
+
+
+# The policy our datastore transactions use.
+default_policy = RetryPolicy()
+
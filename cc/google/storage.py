@@ -1,23 +1,66 @@
 # https://google-cloud-python.readthedocs.io/en/stable/storage/client.html
 
-import logging, time
+import logging, threading, time
+from concurrent import futures
 from datetime import datetime, timezone
-from google.cloud import storage
 
+from typing import Any, Dict, List
+
+from cloud_common.cc import utils
+from cloud_common.cc import parallel
+from cloud_common.cc.google import clients
 from cloud_common.cc.google import env_vars
 
-# Storage client for Google Cloud
-storage_client = storage.Client(env_vars.cloud_project_id)
+# Loaded on first use, it is slow to import.
+storage = utils.lazy_import('google.cloud.storage')
 
 DEBIAN_PACKAGE_BUCKET = 'openag-v1-debian-packages'
 IMAGE_BUCKET = 'openag-v1-images'
 
 URL_TEMPLATE = 'https://console.cloud.google.com/storage/browser/{}?project=openag-v1'
 
+# Blobs listed per request, and deleted per batch request (the batch max).
+LIST_PAGE_SIZE = 1000
+DELETE_BATCH_SIZE = 100
+
+# Files checked at the same time by get_files_exist(), on its own small
+# thread pool (not the shared one), and the longest to wait for each batch.
+EXISTS_MAX_WORKERS = 4
+EXISTS_BATCH_SIZE = 50
+EXISTS_TIMEOUT_SECS = 10.0
+
+# Globals
+__exists_executor = None
+__exists_executor_lock = threading.Lock()
+
+
+#------------------------------------------------------------------------------
+# Storage client for Google Cloud
+def create_client() -> Any:
+    return storage.Client(env_vars.cloud_project_id)
+
+
+#------------------------------------------------------------------------------
+# Returns the shared (per process) storage client.
+def get_client() -> Any:
+    return clients.get_client(clients.STORAGE)
+
+
+#------------------------------------------------------------------------------
+# The old storage_client module global, now made on first use.
+def __getattr__(name: str) -> Any:
+    if 'storage_client' == name:
+        return get_client()
+    raise AttributeError(f'module {__name__} has no attribute {name}')
+
+
+clients.register(clients.STORAGE, create_client)
+
+
 #------------------------------------------------------------------------------
 def get_latest_debian_package_from_storage():
     try:
-        bucket = storage_client.get_bucket(DEBIAN_PACKAGE_BUCKET)
+        bucket = get_client().get_bucket(DEBIAN_PACKAGE_BUCKET)
         blobs = list(bucket.list_blobs())
         # Blobs seem to come back in the order you'd expect. 
         # So take the last one that ends in '.deb'
@@ -36,7 +79,7 @@ def get_latest_debian_package_from_storage():
 #------------------------------------------------------------------------------
 def get_latest_backup_from_storage():
     try:
-        buckets = list(storage_client.list_buckets(prefix='openag-v1-backup-'))
+        buckets = list(get_client().list_buckets(prefix='openag-v1-backup-'))
         return buckets[-1].name
     except:
         logging.error('no backup buckets.')
@@ -51,19 +94,95 @@ def get_images_URL_from_storage():
 #------------------------------------------------------------------------------
 def delete_files_over_two_hours_old(bucket_name):
     # Remove any files in the uploads bucket that are over 2 hours old
+    return delete_stale_files(bucket_name, 2 * 60 * 60)
+
+
+#------------------------------------------------------------------------------
+# Delete the files in a bucket that are at least max_age_seconds old.
+# Lists a page of names and creation times at a time (for each prefix, or 
+# the whole bucket), and deletes the stale files in batch requests.
+# Returns a dict of stats: 
+#   {'scanned': files listed, 'deleted': files deleted, 'seconds': time}
+def delete_stale_files(bucket_name: str, max_age_seconds: float,
+        prefixes: List[str] = None) -> Dict[str, Any]:
+    start = time.time()
+    res = {'scanned': 0, 'deleted': 0, 'seconds': 0.0}
     now = datetime.now(timezone.utc) # use same TZ as storage
-    bucket = storage_client.get_bucket(bucket_name)
-    blobs = bucket.list_blobs()
-    for blob in blobs:
-        time_created = blob.time_created # datetime or None
-        delta = now - time_created
-        if delta.total_seconds() >= 2 * 60 * 60:
-            try:
-                blob.delete()
-            except:
-                pass 
-            logging.info(f'storage.delete_files_over_two_hours_old: '
-                    f'Removing stale file={blob.path}')
+    bucket = get_client().bucket(bucket_name) # no request, unlike get_bucket
+    for prefix in prefixes or [None]:
+        page_token = None
+        while True:
+            blobs = bucket.list_blobs(prefix=prefix, 
+                    max_results=LIST_PAGE_SIZE, page_token=page_token,
+                    fields='items(name,timeCreated),nextPageToken')
+            page = next(blobs.pages, [])
+            stale = []
+            for blob in page:
+                res['scanned'] += 1
+                time_created = blob.time_created # datetime or None
+                if time_created is not None and \
+                        (now - time_created).total_seconds() >= max_age_seconds:
+                    stale.append(blob)
+            res['deleted'] += __delete_blobs(stale)
+            page_token = blobs.next_page_token
+            if page_token is None:
+                break
+    res['seconds'] = round(time.time() - start, 3)
+    logging.info(f'storage.delete_stale_files: deleted {res["deleted"]} of '
+            f'{res["scanned"]} files in {bucket_name} in '
+            f'{res["seconds"]} secs.')
+    return res
+
+
+#------------------------------------------------------------------------------
+# Private: delete blobs, DELETE_BATCH_SIZE per batch request.
+# Returns the number deleted.
+def __delete_blobs(blobs: List) -> int:
+    deleted = 0
+    for i in range(0, len(blobs), DELETE_BATCH_SIZE):
+        chunk = blobs[i:i + DELETE_BATCH_SIZE]
+        try:
+            with get_client().batch():
+                for blob in chunk:
+                    blob.delete()
+            deleted += len(chunk)
+        except Exception as e:
+            # some may be gone already, they are retried on the next run
+            logging.error(f'storage.__delete_blobs: batch of {len(chunk)} '
+                    f'failed: {e}')
+    return deleted
+
+
+#------------------------------------------------------------------------------
+# Returns a dict of file name: True if the file is in a bucket, or False.
+# Each file is checked on its own, EXISTS_BATCH_SIZE at the same time, so
+# this doesn't depend on how many files are in the bucket.  Files that
+# couldn't be checked (timed out or error) are left out, they are unknown.
+def get_files_exist(bucket_name: str, 
+        file_names: List[str]) -> Dict[str, bool]:
+    bucket = get_client().bucket(bucket_name) # no request, unlike get_bucket
+    names = sorted(set(file_names))
+    res = {}
+    for i in range(0, len(names), EXISTS_BATCH_SIZE):
+        checked = parallel.run_in_parallel(
+                {name: bucket.blob(name).exists 
+                    for name in names[i:i + EXISTS_BATCH_SIZE]},
+                EXISTS_TIMEOUT_SECS, __get_exists_executor())
+        checked.pop(parallel.ERRORS_KEY, None)
+        res.update({name: bool(exists) for name, exists in checked.items()})
+    return res
+
+
+#------------------------------------------------------------------------------
+# Private: returns the thread pool for get_files_exist().
+def __get_exists_executor() -> futures.ThreadPoolExecutor:
+    global __exists_executor
+    with __exists_executor_lock:
+        if __exists_executor is None:
+            __exists_executor = futures.ThreadPoolExecutor(
+                    max_workers=EXISTS_MAX_WORKERS,
+                    thread_name_prefix='storage-exists')
+        return __exists_executor
 
 
 #------------------------------------------------------------------------------
@@ -73,8 +192,8 @@ def delete_files_over_two_hours_old(bucket_name):
 # Returns the public URL in the new location, or None for error.
 def moveFileBetweenBuckets(src_bucket, dest_bucket, file_name):
     try:
-        src = storage_client.get_bucket(src_bucket)
-        dest = storage_client.get_bucket(dest_bucket)
+        src = get_client().get_bucket(src_bucket)
+        dest = get_client().get_bucket(dest_bucket)
 
         # get image in source bucket
         src_image = src.get_blob(file_name)
@@ -102,9 +221,9 @@ def moveFileBetweenBuckets(src_bucket, dest_bucket, file_name):
 # Return the public URL to the file in a cloud storage bucket.
 def saveFile(varName, imageType, imageBytes, deviceId ):
 
-    bucket = storage_client.get_bucket(env_vars.cs_bucket)
+    bucket = get_client().get_bucket(env_vars.cs_bucket)
     filename = '{}_{}_{}.{}'.format( deviceId, varName,
-        time.strftime( '%FT%XZ', time.gmtime() ), imageType )
+        utils.utc_timestamp(), imageType )
     blob = bucket.blob( filename ) # make a new blob
 
     content_type = 'image/{}'.format( imageType )
@@ -121,7 +240,7 @@ def saveFile(varName, imageType, imageBytes, deviceId ):
 # Returns True or False.
 def isUploadedImageInBucket(file_name, src_bucket_name):
 
-    src_bucket = storage_client.get_bucket(src_bucket_name)
+    src_bucket = get_client().get_bucket(src_bucket_name)
     src_image = src_bucket.get_blob(file_name)
     if src_image is None:
         logging.debug("storage.isUploadedImageInBucket: file NOT in bucket={}"
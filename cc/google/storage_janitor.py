@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+""" Storage Janitor.
+    - Deletes the stale files (over two hours old) in the image upload
+      bucket.  Most files are moved out of it as soon as they are uploaded,
+      so these are the ones that never got finalized.  Also deletes the 
+      pending upload records that old, their files are gone.
+    - Runs at most once per STORAGE_JANITOR_INTERVAL_SECS in each process,
+      and across all processes (services) by taking a lease in the
+      datastore, so it is cheap to call run_if_due() on a hot path.
+    - Only lists the files under the STORAGE_JANITOR_PREFIXES, if set.
+    - The work is done on its own (daemon) thread, not the caller's thread
+      or the shared thread pool, which is for short queries.
+"""
+
+import logging, threading, time
+
+from typing import Any, Dict, List
+
+from cloud_common.cc.google import env_vars
+from cloud_common.cc.google import storage
+from cloud_common.cc.google import datastore
+
+
+# Files at least this old are deleted.
+MAX_FILE_AGE_SECS = 2 * 60 * 60
+
+# The datastore lease name.
+LEASE_NAME = 'storage_janitor'
+
+# Globals
+__lock = threading.Lock()
+__next_run = 0.0 # time.monotonic() of the earliest next run in this process
+__last_stats = {} # stats of the last run in this process
+
+
+#------------------------------------------------------------------------------
+# Returns the least seconds between runs.
+def get_interval_seconds() -> float:
+    return float(env_vars.storage_janitor_interval_secs)
+
+
+#------------------------------------------------------------------------------
+# Returns the list of file name prefixes to clean, or None for all files.
+def get_prefixes() -> List[str]:
+    prefixes = [p.strip() for p in env_vars.storage_janitor_prefixes.split(',')]
+    prefixes = [p for p in prefixes if 0 < len(p)]
+    return prefixes or None
+
+
+#------------------------------------------------------------------------------
+# Clean the upload bucket in the background, if it is due.
+# Returns True if a run was started.
+def run_if_due() -> bool:
+    global __next_run
+    now = time.monotonic()
+    if now < __next_run: # fast path, no lock
+        return False
+    with __lock:
+        if now < __next_run:
+            return False # another thread just started a run
+        __next_run = now + get_interval_seconds()
+    threading.Thread(target=run, name='storage-janitor', daemon=True).start()
+    return True
+
+
+#------------------------------------------------------------------------------
+# Clean the upload bucket now, if no other process has in the last interval.
+# Returns a dict of stats: {'scanned', 'deleted', 'seconds'}, or an empty
+# dict if another process has the lease.
+def run() -> Dict[str, Any]:
+    global __last_stats
+    try:
+        if not datastore.acquire_lease_in_DS(LEASE_NAME,
+                get_interval_seconds()):
+            logging.debug('storage_janitor.run: another process has the lease')
+            return {}
+        stats = storage.delete_stale_files(env_vars.cs_upload_bucket,
+                MAX_FILE_AGE_SECS, get_prefixes())
+        stats['pending_deleted'] = \
+                datastore.delete_stale_pending_image_uploads_from_DS(
+                        MAX_FILE_AGE_SECS)
+        with __lock:
+            __last_stats = stats
+        return stats
+    except Exception as e:
+        logging.critical(f'Exception in storage_janitor.run(): {e}')
+        return {}
+
+
+#------------------------------------------------------------------------------
+# Returns the stats of the last run in this process (empty if none).
+def get_last_stats() -> Dict[str, Any]:
+    with __lock:
+        return dict(__last_stats)
+
@@ -14,13 +14,15 @@ from datetime import datetime
 
 from typing import Dict
 
-from google.cloud import datastore as gcds
-
 from cloud_common.cc import utils 
 from cloud_common.cc.google import env_vars 
 from cloud_common.cc.google import storage 
 from cloud_common.cc.google import datastore 
 from cloud_common.cc.google import bigquery 
+from cloud_common.cc.google.bigquery_row_buffer import BigQueryRowBuffer
+
+# Loaded on first use, it is slow to import.
+gcds = utils.lazy_import('google.cloud.datastore')
 
 
 # You get the idea this is deprecated old code, right?  It will go away soon.
@@ -44,8 +46,10 @@ class DeprecatedImageChunking:
 
 
     #--------------------------------------------------------------------------
-    def __init__(self):
-        self.DS = datastore.create_client()
+    # Pass in a BigQueryRowBuffer to batch the BQ inserts.
+    def __init__(self, bq_row_buffer: BigQueryRowBuffer = None):
+        self.bq_row_buffer = bq_row_buffer
+        self.DS = datastore.get_client()
         if self.DS is None:
             logging.critical('deprecated_image_chunking has no DS')
 
@@ -74,6 +78,7 @@ class DeprecatedImageChunking:
             'timestamp': datetime.now()
             } )
         self.DS.put( chunk )  
+        datastore.increment_entity_counter_in_DS( datastore.DS_cache_KIND )
         logging.debug( 'saveImageChunkToDatastore: saved to MqttServiceCache '
             '{}, {} of {} for {}'.format( 
                 messageId, chunkNum, totalChunks, deviceId ))
@@ -109,9 +114,14 @@ class DeprecatedImageChunking:
         query.add_filter( 'deviceId', '=', deviceId )
         query.add_filter( 'messageId', '=', messageId )
         qiter = query.fetch()
+        deleted = 0
         for entity in qiter:
             self.DS.delete( entity.key )
+            deleted += 1
             logging.debug( "deleteImageChunksFromDatastore: chunk {} of messageId {} deleted.".format( entity.get( 'chunkNum', '?' ), messageId ))
+        if 0 < deleted:
+            datastore.increment_entity_counter_in_DS( datastore.DS_cache_KIND,
+                    -deleted )
         return
 
 
@@ -126,6 +136,7 @@ class DeprecatedImageChunking:
             'timestamp': datetime.now()
             } )
         self.DS.put( turd )  
+        datastore.increment_entity_counter_in_DS( datastore.DS_turds_KIND )
         logging.debug( 'saveTurd: saved to MqttServiceTurds {} for {}'.format( 
                 messageId, deviceId ))
         return 
@@ -156,8 +167,13 @@ class DeprecatedImageChunking:
         query.add_filter( 'deviceId', '=', deviceId )
         query.add_filter( 'messageId', '=', messageId )
         qiter = query.fetch()
+        deleted = 0
         for entity in qiter:
             self.DS.delete( entity.key )
+            deleted += 1
+        if 0 < deleted:
+            datastore.increment_entity_counter_in_DS( datastore.DS_turds_KIND,
+                    -deleted )
         logging.debug( "deleteTurd: messageId {} deleted.".format( messageId ))
         return
 
@@ -273,7 +289,10 @@ class DeprecatedImageChunking:
             message_obj[ self.values_KEY ] = valuesJson
             rowsList = []
             self.makeBQEnvVarRowList(message_obj, deviceId, rowsList)
-            bigquery.data_insert(rowsList)
+            if self.bq_row_buffer is not None:
+                self.bq_row_buffer.push(rowsList)
+            else:
+                bigquery.data_insert(rowsList)
 
         except Exception as e:
             exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -303,7 +322,7 @@ class DeprecatedImageChunking:
         ID = idKey + '~{}~{}~' + deviceId
 
         row = (ID.format(varName, 
-            time.strftime('%FT%XZ', time.gmtime())), # id column
+            utils.utc_timestamp()), # id column
             values, 0, 0) # values column, with zero for X, Y
 
         rowsList.append(row)
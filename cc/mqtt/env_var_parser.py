@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+""" EnvVar (and CommandReply) message values parser.
+    - The 'values' string of a message is a python literal like:
+        "{'values':[{'name':'temp', 'type':'float', 'value':22.5}]}"
+      and older brains embed a string in the string, which isn't valid:
+        "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}"
+    - parse_values() gets the (name, type, value) of the first value in one
+      pass: json (after swapping the quotes) for the common case, a compiled
+      regex for the embedded string form, and ast.literal_eval() only when
+      neither works.
+    - See scripts/benchmark_envvar_parsing.py
+"""
+
+import ast, json, re
+
+from typing import Any, Tuple
+
+
+# The embedded string form, the name, type and value are the first ones.
+# (the value ends at the first '}]}', less its closing quote)
+NAME_RE = re.compile(r"'name':'([^']*)'")
+TYPE_RE = re.compile(r"'type':'([^']*)'")
+VALUE_RE = re.compile(r"'value':'(.*?).\}\]\}", re.DOTALL)
+
+
+#------------------------------------------------------------------------------
+# Returns the (name, type, value) of the first value in a values string.
+# The value is a python object (float, dict, str ...).  If the string can't
+# be parsed, returns the name and type found in it (or None) and the string.
+def parse_values(string: str) -> Tuple[Any, Any, Any]:
+    # Fast path: single quoted literals of numbers, strings, lists and dicts
+    # are json once the quotes are swapped.  (not if there are double quotes
+    # or escapes, which would change meaning)
+    if '"' not in string and '\\' not in string:
+        try:
+            return __first_value(__json_loads(string.replace("'", '"')))
+        except (ValueError, LookupError, TypeError):
+            pass
+
+    # A string embedded in the string (its quotes are not escaped).
+    match = VALUE_RE.search(string)
+    if match is not None and "'" in match.group(1):
+        try:
+            return __name_and_type(string) + (__parse_literal(match.group(1)),)
+        except (ValueError, SyntaxError, TypeError, MemoryError,
+                RecursionError):
+            pass
+
+    # Last resort, the slowest parser.
+    try:
+        return __first_value(ast.literal_eval(string))
+    except Exception:
+        return __name_and_type(string) + (string,)
+
+
+#------------------------------------------------------------------------------
+# Private: returns the (name, type, value) of the first dict in 'values'.
+def __first_value(values: Any) -> Tuple[Any, Any, Any]:
+    first = values['values'][0]
+    return first['name'], first.get('type'), first['value']
+
+
+#------------------------------------------------------------------------------
+# Private: returns the (name, type) found by scanning a values string.
+def __name_and_type(string: str) -> Tuple[Any, Any]:
+    name = NAME_RE.search(string)
+    type_ = TYPE_RE.search(string)
+    return (name.group(1) if name else None, type_.group(1) if type_ else None)
+
+
+#------------------------------------------------------------------------------
+# Private: json.loads() that rejects what literal_eval() would: NaN, 
+# Infinity, null, true and false.
+def __json_loads(string: str) -> Any:
+    value = json.loads(string, parse_constant=__reject_constant)
+    __reject_json_literals(value)
+    return value
+
+
+#------------------------------------------------------------------------------
+# Private: json parse_constant hook.
+def __reject_constant(constant: str) -> Any:
+    raise ValueError(f'not a python literal: {constant}')
+
+
+#------------------------------------------------------------------------------
+# Private: raises ValueError if a parsed json value has a None or bool in it,
+# which only come from json's null, true and false.
+def __reject_json_literals(value: Any) -> None:
+    if value is None or isinstance(value, bool):
+        raise ValueError(f'not a python literal: {json.dumps(value)}')
+    if isinstance(value, dict):
+        for v in value.values():
+            __reject_json_literals(v)
+    elif isinstance(value, list):
+        for v in value:
+            __reject_json_literals(v)
+
+
+#------------------------------------------------------------------------------
+# Private: parse a python literal, as json first if it is safe to.
+def __parse_literal(string: str) -> Any:
+    if '"' not in string and '\\' not in string:
+        try:
+            return __json_loads(string.replace("'", '"'))
+        except ValueError:
+            pass
+    return ast.literal_eval(string)
+
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+""" Image Upload Finalizer class.
+    - Devices upload images to the upload bucket (via a cloud function),
+      then send an ImageUpload message.  The file can show up in the bucket
+      a while after the message.
+    - Instead of holding the message handler until the file is there,
+      add() saves a pending upload record in the datastore, finalizes the
+      upload right away if the file is already there (the storage 
+      notification can come first) and returns.
+    - The upload is finalized (moved, its URL saved, inserted in BQ) by the
+      finalize callback when the file is in the bucket.  Either from a
+      storage notification (handle_storage_notification()), or by the one
+      poller thread (start()), which checks all the pending files at the
+      same time (not by listing the bucket, which can be big).
+    - Pending uploads that don't show up in max_age_seconds are dropped by
+      the poller, and the storage janitor drops any left after that.
+"""
+
+import logging, threading, time
+
+from typing import Callable, Dict
+
+from cloud_common.cc.google import env_vars
+from cloud_common.cc.google import storage
+from cloud_common.cc.google import datastore
+
+
+class ImageUploadFinalizer:
+
+    # The storage notification event for a new (or overwritten) file.
+    OBJECT_FINALIZE = 'OBJECT_FINALIZE'
+
+    # For logging
+    name: str = 'cloud_common.cc.mqtt.image_upload_finalizer'
+
+
+    #--------------------------------------------------------------------------
+    # finalize: function(device_ID, var_name, file_name) that finalizes an
+    #           uploaded file, returns True if done.  Defaults to
+    #           MQTTMessaging.finalize_uploaded_image when this is passed
+    #           to MQTTMessaging.
+    # poll_seconds: how often the poller checks the pending uploads.
+    # max_age_seconds: how long to wait for a file to be uploaded.
+    # upload_bucket: defaults to the CS_UPLOAD_BUCKET env. var.
+    def __init__(self, finalize: Callable[[str, str, str], bool] = None,
+            poll_seconds: float = 10.0, max_age_seconds: float = 5 * 60,
+            upload_bucket: str = None) -> None:
+        self.finalize = finalize
+        self.poll_seconds = poll_seconds
+        self.max_age_seconds = max_age_seconds
+        self.upload_bucket = upload_bucket or env_vars.cs_upload_bucket
+        self.__in_progress = set() # file names being finalized
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+
+    #--------------------------------------------------------------------------
+    # Save a pending upload, to be finalized when the file is uploaded, or
+    # now if it already is.
+    # Returns True for success or False for error.
+    def add(self, device_ID: str, var_name: str, file_name: str) -> bool:
+        if not datastore.save_pending_image_upload_in_DS(device_ID,
+                file_name, var_name):
+            logging.error(f'{self.name}.add: failed to save {file_name}')
+            return False
+        if storage.get_files_exist(self.upload_bucket, 
+                [file_name]).get(file_name):
+            self.__finalize(file_name, {
+                datastore.DS_device_uuid_KEY: device_ID,
+                datastore.DS_camera_name_KEY: var_name})
+            return True
+        logging.debug(f'{self.name}.add: waiting for {file_name}')
+        return True
+
+
+    #--------------------------------------------------------------------------
+    # Handle a cloud storage pubsub notification (pass the message
+    # attributes), finalizes the upload if the file is one we are waiting on.
+    # Returns True if an upload was finalized.
+    def handle_storage_notification(self, attributes: Dict[str, str]) -> bool:
+        if self.OBJECT_FINALIZE != attributes.get('eventType') or \
+                self.upload_bucket != attributes.get('bucketId'):
+            return False
+        file_name = attributes.get('objectId')
+        pending = datastore.get_pending_image_upload_from_DS(file_name)
+        if pending is None:
+            return False # not ours, or already finalized
+        return self.__finalize(file_name, pending)
+
+
+    #--------------------------------------------------------------------------
+    # Check if the pending uploads are in the upload bucket, finalize the
+    # files that are there and drop the ones that are too old (and known
+    # not to be there).
+    # Returns a dict of counts: pending, finalized, expired.
+    def poll_once(self) -> Dict[str, int]:
+        res = {'pending': 0, 'finalized': 0, 'expired': 0}
+        pendings = datastore.get_pending_image_uploads_from_DS()
+        res['pending'] = len(pendings)
+        if 0 == len(pendings):
+            return res
+
+        uploaded = storage.get_files_exist(self.upload_bucket,
+                [p.key.id_or_name for p in pendings])
+
+        now = time.time()
+        expired = []
+        for pending in pendings:
+            file_name = pending.key.id_or_name
+            exists = uploaded.get(file_name) # None if it couldn't be checked
+            if exists is None:
+                continue # try again on the next poll
+            if exists and self.__finalize(file_name, pending):
+                res['finalized'] += 1
+            elif not exists and \
+                    now - pending.get(datastore.DS_created_epoch_KEY, 0) > \
+                    self.max_age_seconds:
+                logging.warning(f'{self.name}.poll_once: gave up on '
+                        f'{file_name}')
+                expired.append(file_name)
+        if 0 < len(expired):
+            datastore.delete_pending_image_uploads_from_DS(expired)
+            res['expired'] = len(expired)
+        return res
+
+
+    #--------------------------------------------------------------------------
+    # Start the poller thread (once).
+    def start(self) -> None:
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__poll,
+                    name='image-upload-finalizer', daemon=True)
+            self.__thread.start()
+
+
+    #--------------------------------------------------------------------------
+    # Stop the poller thread.
+    def stop(self) -> None:
+        with self.__lock:
+            thread = self.__thread
+            self.__thread = None
+        self.__stop.set()
+        if thread is not None:
+            thread.join()
+
+
+    #--------------------------------------------------------------------------
+    # Private: the poller thread.
+    def __poll(self) -> None:
+        while not self.__stop.wait(self.poll_seconds):
+            try:
+                self.poll_once()
+            except Exception as e:
+                logging.critical(f'Exception in {self.name}.__poll(): {e}')
+
+
+    #--------------------------------------------------------------------------
+    # Private: finalize one upload (unless another thread is doing it) and
+    # delete its pending record.
+    # Returns True if finalized.
+    def __finalize(self, file_name: str, pending: Dict) -> bool:
+        with self.__lock:
+            if file_name in self.__in_progress:
+                return False
+            self.__in_progress.add(file_name)
+        try:
+            device_ID = pending.get(datastore.DS_device_uuid_KEY)
+            var_name = pending.get(datastore.DS_camera_name_KEY)
+            if not self.finalize(device_ID, var_name, file_name):
+                return False # try again on the next poll
+            datastore.delete_pending_image_uploads_from_DS([file_name])
+            return True
+        except Exception as e:
+            logging.critical(f'Exception in {self.name}.__finalize(): '
+                    f'{file_name} {e}')
+            return False
+        finally:
+            with self.__lock:
+                self.__in_progress.discard(file_name)
+
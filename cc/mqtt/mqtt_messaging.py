@@ -4,19 +4,24 @@
     - Handles messages published by our devices.
 """
 
-import sys, logging, ast, time
+import sys, logging, time
 from datetime import datetime
 
-from typing import Dict
+from typing import Dict, List, Tuple
 
 from cloud_common.cc import utils 
 from cloud_common.cc.google import env_vars 
-from cloud_common.cc.google import pubsub # takes 15 secs to load...
+from cloud_common.cc.google import pubsub # the pubsub lib is loaded lazily
 from cloud_common.cc.google import storage 
+from cloud_common.cc.google import storage_janitor
 from cloud_common.cc.google import datastore 
 from cloud_common.cc.google import bigquery 
+from cloud_common.cc.google.bigquery_row_buffer import BigQueryRowBuffer
+from cloud_common.cc.google.device_data_writer import DeviceDataWriter
 from cloud_common.cc.notifications.notification_messaging import NotificationMessaging
 from cloud_common.cc.mqtt.deprecated_image_chunking import DeprecatedImageChunking
+from cloud_common.cc.mqtt.image_upload_finalizer import ImageUploadFinalizer
+from cloud_common.cc.mqtt import env_var_parser
 
 class MQTTMessaging:
 
@@ -53,8 +58,22 @@ class MQTTMessaging:
 
 
     #--------------------------------------------------------------------------
-    def __init__(self) -> None:
+    # Pass in a DeviceDataWriter to coalesce the DeviceData writes of message
+    # bursts (and call its flush() at shutdown).
+    # Pass in a BigQueryRowBuffer to batch the BQ inserts of all messages.
+    # Pass in an ImageUploadFinalizer to finalize uploaded images later, 
+    # instead of waiting for them in the message handler (and call its 
+    # start() and/or handle_storage_notification()).
+    def __init__(self, device_data_writer: DeviceDataWriter = None,
+            bq_row_buffer: BigQueryRowBuffer = None,
+            image_upload_finalizer: ImageUploadFinalizer = None) -> None:
         self.notification_messaging = NotificationMessaging()
+        self.device_data_writer = device_data_writer
+        self.bq_row_buffer = bq_row_buffer
+        self.image_upload_finalizer = image_upload_finalizer
+        if image_upload_finalizer is not None and \
+                image_upload_finalizer.finalize is None:
+            image_upload_finalizer.finalize = self.finalize_uploaded_image
 
 
     #--------------------------------------------------------------------------
@@ -67,7 +86,7 @@ class MQTTMessaging:
         if self.messageType_Image == self.get_message_type(message):
             #logging.warning(f'{self.name}.parse: ignoring old chunked images '
             #        'from old clients.')
-            deprecated = DeprecatedImageChunking()
+            deprecated = DeprecatedImageChunking(self.bq_row_buffer)
             deprecated.save_old_chunked_image(message, device_ID)
             return 
 
@@ -103,7 +122,66 @@ class MQTTMessaging:
         # Also insert into BQ (Env vars and command replies)
         rowsList = []
         if self.makeBQRowList(message, device_ID, rowsList):
-            bigquery.data_insert(rowsList)
+            self.insert_BQ_rows(rowsList)
+
+
+    #--------------------------------------------------------------------------
+    # Parse a batch of pubsub messages, a list of (device_ID, message) pairs.
+    # Image, image upload and recipe event messages are handled one at a time
+    # (the same as parse()).  The EnvVar and CommandReply messages are 
+    # grouped by device: one DeviceData update per device, and one BigQuery
+    # insert for the whole batch.
+    # Returns the number of valid messages handled.
+    def parse_batch(self, messages: List[Tuple[str, Dict[str, str]]]) -> int:
+        handled = 0
+        pushes = {} # device_ID: {var name: [value dicts, oldest first]}
+        rowsList = []
+        for device_ID, message in messages:
+            try:
+                if not self.validate_message(message):
+                    logging.error(f'{self.name}.parse_batch: invalid '
+                            f'message={message}')
+                    continue
+                handled += 1
+
+                message_type = self.get_message_type(message)
+                if self.messageType_EnvVar != message_type and \
+                        self.messageType_CommandReply != message_type:
+                    self.parse(device_ID, message)
+                    continue
+
+                res = self.make_device_data_value(message)
+                if res is not None:
+                    varName, valueToSave = res
+                    pushes.setdefault(device_ID, {}).setdefault(
+                            varName, []).append(valueToSave)
+                self.makeBQRowList(message, device_ID, rowsList)
+
+            except Exception as e:
+                logging.critical(f'Exception in {self.name}.parse_batch(): '
+                        f'device_ID={device_ID} {e}')
+
+        # Save the most recent data as properties on the Device entity in the
+        # datastore, one update per device.
+        for device_ID, device_pushes in pushes.items():
+            try:
+                if self.device_data_writer is not None:
+                    for varName, values in device_pushes.items():
+                        for valueToSave in values:
+                            self.device_data_writer.push(device_ID, varName,
+                                    valueToSave)
+                elif not datastore.push_dicts_onto_device_data_queues(
+                        device_ID, device_pushes):
+                    logging.error(f'{self.name}.parse_batch: DeviceData '
+                            f'update failed for device_ID={device_ID}')
+            except Exception as e:
+                logging.critical(f'Exception in {self.name}.parse_batch(): '
+                        f'device_ID={device_ID} {e}')
+
+        # Also insert into BQ (Env vars and command replies), all at once.
+        if 0 < len(rowsList):
+            self.insert_BQ_rows(rowsList)
+        return handled
 
 
     #--------------------------------------------------------------------------
@@ -140,6 +218,15 @@ class MQTTMessaging:
         return True
 
 
+    #--------------------------------------------------------------------------
+    # Insert rows into BQ, through the row buffer if we have one.
+    def insert_BQ_rows(self, rowsList) -> None:
+        if self.bq_row_buffer is not None:
+            self.bq_row_buffer.push(rowsList)
+        else:
+            bigquery.data_insert(rowsList)
+
+
     #--------------------------------------------------------------------------
     # Returns the messageType key if valid, else None.
     def get_message_type(self, message):
@@ -189,7 +276,7 @@ class MQTTMessaging:
         ID = idKey + '~{}~{}~' + deviceId
 
         row = (ID.format(varName, 
-            time.strftime('%FT%XZ', time.gmtime())), # id column
+            utils.utc_timestamp()), # id column
             values, 0, 0) # values column, with zero for X, Y
 
         rowsList.append(row)
@@ -221,80 +308,47 @@ class MQTTMessaging:
     # that produced them - for UI display / charting.
     def save_data_to_Device(self, pydict, deviceId):
         try:
-            if self.messageType_EnvVar != self.get_message_type(pydict) and \
-            self.messageType_CommandReply != self.get_message_type(pydict):
-                return
-
-            # each received EnvVar type message must have these fields
-            if not utils.key_in_dict(pydict, self.var_KEY ) or \
-                not utils.key_in_dict(pydict, self.values_KEY ):
-                logging.error('save_data_to_Device: Missing key(s) in dict.')
+            res = self.make_device_data_value(pydict)
+            if res is None:
                 return
-            varName = pydict[ self.var_KEY ]
+            varName, valueToSave = res
 
-            value = self.__string_to_value( pydict[ self.values_KEY ] )
-            name = self.__string_to_name( pydict[ self.values_KEY ] )
-            valueToSave = { 
-                'timestamp': str( time.strftime( '%FT%XZ', time.gmtime())),
-                'name': str( name ),
-                'value': str( value ) }
-
-            datastore.push_dict_onto_device_data_queue(deviceId,
-                    varName, valueToSave)
+            if self.device_data_writer is not None:
+                self.device_data_writer.push(deviceId, varName, valueToSave)
+            else:
+                datastore.push_dict_onto_device_data_queue(deviceId,
+                        varName, valueToSave)
 
         except Exception as e:
             logging.critical(f"Exception in save_data_to_Device(): {e}")
 
 
     #--------------------------------------------------------------------------
-    # Private method to get the value from a string of data from the device
-    # or DB.  Handles weird stuff like a string in a string.
-    def __string_to_value(self, string):
-        try:
-            values = ast.literal_eval( string ) # if this works, great!
-            firstVal = values['values'][0]
-            return firstVal['value']
-        except:
-            # If the above has issues, the string probably has an embedded string.
-            # Such as this:
-            # "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}"
-            valueTag = "\'value\':\'"
-            endTag = "}]}"
-            valueStart = string.find( valueTag )
-            valueEnd = string.find( endTag )
-            if -1 == valueStart or -1 == valueEnd:
-                return string
-            valueStart += len( valueTag )
-            valueEnd -= 1
-            val = string[ valueStart:valueEnd ]
-            return ast.literal_eval(val) # let exceptions from this flow up
-        return string
+    # Returns the (var name, value dict) to push onto the DeviceData queue
+    # for an EnvVar or CommandReply message, or None if there is nothing 
+    # to save.
+    def make_device_data_value(self, pydict):
+        if self.messageType_EnvVar != self.get_message_type(pydict) and \
+        self.messageType_CommandReply != self.get_message_type(pydict):
+            return None
 
+        # each received EnvVar type message must have these fields
+        if not utils.key_in_dict(pydict, self.var_KEY ) or \
+            not utils.key_in_dict(pydict, self.values_KEY ):
+            logging.error('make_device_data_value: Missing key(s) in dict.')
+            return None
+        varName = pydict[ self.var_KEY ]
 
-    #--------------------------------------------------------------------------
-    # Private method to get the name from a string of data from the device
-    # or DB.  Handles weird stuff like a string in a string.
-    def __string_to_name(self, string):
-        try:
-            values = ast.literal_eval( string ) # if this works, great!
-            firstVal = values['values'][0]
-            return firstVal['name']
-        except:
-            # If the above has issues, the string probably has an embedded string.
-            # Such as this:
-            # "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}"
-            nameTag = "\'name\':\'"
-            endTag = "\'"
-            nameStart = string.find( nameTag )
-            if -1 == nameStart:
-                return None
-            nameStart += len( nameTag )
-            nameEnd = string.find( endTag, nameStart )
-            if -1 == nameEnd:
-                return None
-            name = string[ nameStart:nameEnd ]
-            return name
-        return ''
+        name, _, value = env_var_parser.parse_values(
+                pydict[ self.values_KEY ] )
+        epoch = int(time.time())
+        valueToSave = { 
+            'timestamp': utils.utc_timestamp(epoch),
+            'name': str( name ),
+            'value': str( value ) }
+        if 'true' == env_vars.device_data_epoch:
+            valueToSave['epoch'] = epoch
+        return varName, valueToSave
 
 
     #--------------------------------------------------------------------------
@@ -303,6 +357,8 @@ class MQTTMessaging:
     # firebase cloud function.   (in an open and un-secured manner) 
     # This is just a message telling us it was done (over the secure IoT 
     # messaging) and gives us a hook to move the image and save its URL.
+    # With an ImageUploadFinalizer, this only saves a pending upload record
+    # and returns, the finalizer calls finalize_uploaded_image() later.
     def save_uploaded_image(self, pydict, deviceId):
         try:
             if self.messageType_ImageUpload != self.get_message_type(pydict):
@@ -318,6 +374,14 @@ class MQTTMessaging:
             var_name =  pydict.get(self.varName_KEY)
             file_name = pydict.get(self.fileName_KEY)
 
+            # Remove any files in the uploads bucket that are over 2 hours 
+            # old (at most once per interval, in the background)
+            storage_janitor.run_if_due()
+
+            if self.image_upload_finalizer is not None:
+                self.image_upload_finalizer.add(deviceId, var_name, file_name)
+                return
+
             start = datetime.now()
             # get a timedelta of the difference
             delta = datetime.now() - start
@@ -325,18 +389,11 @@ class MQTTMessaging:
             # keep checking for image curl upload for 5 minutes
             while delta.total_seconds() <= 5 * 60:
 
-                # Has this image already been handled?
-                # (this can happen since google pub-sub is "at least once" 
-                # message delivery, the same message can get delivered again)
-                if storage.isUploadedImageInBucket(file_name, 
-                        env_vars.cs_bucket):
-                    logging.info(f'save_uploaded_image: file {file_name} '
-                        f'already handled.')
-                    break
-
                 # Check if the file is in the upload bucket.
                 if not storage.isUploadedImageInBucket(file_name, 
-                        env_vars.cs_upload_bucket):
+                        env_vars.cs_upload_bucket) and \
+                        not storage.isUploadedImageInBucket(file_name, 
+                        env_vars.cs_bucket):
                     time.sleep(10)
                     delta = datetime.now() - start
                     logging.debug(f'save_uploaded_image: waited '
@@ -344,45 +401,61 @@ class MQTTMessaging:
                             f'upload of {file_name}')
                     continue
 
-                # Move image from one gstorage bucket to another:
-                #   openag-public-image-uploads > openag-v1-images
-                publicURL = storage.moveFileBetweenBuckets( 
-                        env_vars.cs_upload_bucket, 
-                        env_vars.cs_bucket, file_name)
-                if publicURL is None:
-                    logging.warning(f'save_uploaded_image: '
-                        f'image already moved: {file_name}')
-                    break
-
-                # Put the URL in the datastore for the UI to use.
-                datastore.saveImageURL(deviceId, publicURL, var_name)
-
-                # Put the URL as an env. var in BQ.
-                message_obj = {}
-                # keep old message type, UI code may depend on it
-                message_obj[ self.messageType_KEY ] = self.messageType_Image
-                message_obj[ self.var_KEY ] = var_name
-                valuesJson = "{'values':["
-                valuesJson += "{'name':'URL', 'type':'str', 'value':'%s'}" % \
-                    (publicURL)
-                valuesJson += "]}"
-                message_obj[ self.values_KEY ] = valuesJson
-
-                # Generate the data that will be sent to BigQuery for insertion.
-                # Each value must be a row that matches the table schema.
-                rowsList = []
-                if self.makeBQRowList(message_obj, deviceId, rowsList):
-                    bigquery.data_insert(rowsList)
-
+                self.finalize_uploaded_image(deviceId, var_name, file_name)
                 delta = datetime.now() - start
                 logging.info(f"save_uploaded_image: Done with {file_name} "
                         f"in {delta.total_seconds()} secs")
                 break
-    
-            # Remove any files in the uploads bucket that are over 2 hours old
-            storage.delete_files_over_two_hours_old(env_vars.cs_upload_bucket)
 
         except Exception as e:
             logging.critical(f"Exception in save_uploaded_image(): {e}")
 
 
+    #--------------------------------------------------------------------------
+    # Move an uploaded image to the images bucket, save its URL in the
+    # datastore and insert it in BQ (as an env. var.).
+    # Returns True if done (or already done), False if the file isn't there.
+    def finalize_uploaded_image(self, deviceId, var_name, file_name):
+        try:
+            # Has this image already been handled?
+            # (this can happen since google pub-sub is "at least once" 
+            # message delivery, the same message can get delivered again)
+            if storage.isUploadedImageInBucket(file_name, env_vars.cs_bucket):
+                logging.info(f'finalize_uploaded_image: file {file_name} '
+                    f'already handled.')
+                return True
+
+            # Move image from one gstorage bucket to another:
+            #   openag-public-image-uploads > openag-v1-images
+            publicURL = storage.moveFileBetweenBuckets( 
+                    env_vars.cs_upload_bucket, 
+                    env_vars.cs_bucket, file_name)
+            if publicURL is None:
+                logging.warning(f'finalize_uploaded_image: '
+                    f'image already moved: {file_name}')
+                return False
+
+            # Put the URL in the datastore for the UI to use.
+            datastore.saveImageURL(deviceId, publicURL, var_name)
+
+            # Put the URL as an env. var in BQ.
+            message_obj = {}
+            # keep old message type, UI code may depend on it
+            message_obj[ self.messageType_KEY ] = self.messageType_Image
+            message_obj[ self.var_KEY ] = var_name
+            valuesJson = "{'values':["
+            valuesJson += "{'name':'URL', 'type':'str', 'value':'%s'}" % \
+                (publicURL)
+            valuesJson += "]}"
+            message_obj[ self.values_KEY ] = valuesJson
+
+            # Generate the data that will be sent to BigQuery for insertion.
+            # Each value must be a row that matches the table schema.
+            rowsList = []
+            if self.makeBQRowList(message_obj, deviceId, rowsList):
+                self.insert_BQ_rows(rowsList)
+            return True
+
+        except Exception as e:
+            logging.critical(f"Exception in finalize_uploaded_image(): {e}")
+            return False
@@ -43,8 +43,9 @@ class NotificationData:
     # private internal method
     # Get the list of all notifications for this device ID.
     def __get_all(self, device_ID: str) -> List[Dict[str, str]]:
+        # not cached, the list is modified and saved
         return datastore.get_device_data_property(device_ID, 
-                self.dd_property)
+                self.dd_property, use_cache=False)
 
 
     #--------------------------------------------------------------------------
@@ -60,8 +60,9 @@ class Runs:
     #     start may be None if a recipe has never been run.
     #     end may be None if the run is in progress.
     def get_all(self, device_ID: str) -> List[Dict[str, str]]:
+        # not cached, start() and stop() modify and save the list
         return datastore.get_device_data_property(device_ID, 
-                self.runs_property)
+                self.runs_property, use_cache=False)
 
 
     #--------------------------------------------------------------------------
@@ -80,8 +80,9 @@ class Scheduler:
     # Private getter of the schedule property.
     # Returns a list of dicts.
     def __get_schedule(self, device_ID: str) -> List[Dict[str, str]]:
+        # not cached, the list is modified and saved
         return datastore.get_device_data_property(device_ID, 
-                self.schedule_property)
+                self.schedule_property, use_cache=False)
 
 
     #--------------------------------------------------------------------------
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+""" Parallel calls.
+    - Runs independent, I/O bound calls (e.g. datastore queries) at the same
+      time on a bounded, shared thread pool.  The latency is then that of
+      the slowest call, instead of the sum of all the calls.
+    - Each call has a timeout.  Calls that time out or raise are left out of
+      the results and reported under the ERRORS_KEY, so callers can return
+      partial results.
+"""
+
+import logging, threading, time
+from concurrent import futures
+
+from typing import Any, Callable, Dict
+
+
+# The key of the dict of errors (call name: message) in the results.
+ERRORS_KEY = 'errors'
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT_SECS = 10.0
+
+# Globals
+__executor = None
+__executor_lock = threading.Lock()
+
+
+#------------------------------------------------------------------------------
+# Returns the shared, bounded thread pool.
+def get_executor() -> futures.ThreadPoolExecutor:
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            __executor = futures.ThreadPoolExecutor(
+                    max_workers=DEFAULT_MAX_WORKERS,
+                    thread_name_prefix='cc-parallel')
+        return __executor
+
+
+#------------------------------------------------------------------------------
+# Run some calls at the same time and wait for them all.
+# Args:
+#   calls: dict of call name: function with no args (use a lambda or
+#          functools.partial to pass args).
+#   timeout_seconds: the longest to wait for each call, counted from when
+#          they are all submitted.  (a call that times out keeps running in
+#          its pool thread, but its result is ignored)
+#   executor: to run the calls on, instead of the shared pool (for work that
+#          shouldn't hold the shared pool's threads).
+# Returns a dict of call name: result.  If any call times out or raises, the
+# ERRORS_KEY is added with a dict of call name: error message.
+def run_in_parallel(calls: Dict[str, Callable],
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECS,
+        executor: futures.Executor = None) -> Dict[str, Any]:
+    res = {}
+    errors = {}
+    executor = executor or get_executor()
+    deadline = time.monotonic() + timeout_seconds
+    submitted = {name: executor.submit(func) for name, func in calls.items()}
+    for name, future in submitted.items():
+        try:
+            res[name] = future.result(
+                    timeout=max(0, deadline - time.monotonic()))
+        except futures.TimeoutError:
+            future.cancel() # only works if it has not started
+            errors[name] = f'timed out after {timeout_seconds} secs'
+        except Exception as e:
+            errors[name] = str(e)
+    if 0 < len(errors):
+        logging.error(f'cloud_common.cc.parallel.run_in_parallel: {errors}')
+        res[ERRORS_KEY] = errors
+    return res
+
+
@@ -1,6 +1,18 @@
+import importlib
+import importlib.util
 import string
 import random
+import sys
+import time
+import types
 from datetime import datetime, timezone
+from typing import Any
+
+# Our UTC timestamp string format, e.g. '2019-06-01T12:34:56Z' (same as '%FT%XZ')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Globals
+__last_timestamp = (None, '') # (epoch secs, formatted timestamp)
 
 #------------------------------------------------------------------------------
 def is_expired(expiration_date):
@@ -31,4 +43,100 @@ def bytes_to_string(bs):
     return bs
 
 
+#------------------------------------------------------------------------------
+# Returns a UTC timestamp string (TIMESTAMP_FORMAT) for epoch seconds, 
+# or for now if epoch is None.
+# The last string is cached, so it is only formatted once per second.
+def utc_timestamp(epoch: int = None) -> str:
+    global __last_timestamp
+    if epoch is None:
+        epoch = int(time.time())
+    last_epoch, last_ts = __last_timestamp
+    if epoch == last_epoch:
+        return last_ts
+    ts = time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+    __last_timestamp = (epoch, ts) # one assignment, so thread safe
+    return ts
+
+
+#------------------------------------------------------------------------------
+# Parse a UTC timestamp string (exactly TIMESTAMP_FORMAT) into epoch seconds,
+# without strptime.  Raises ValueError if the string isn't in our format.
+def timestamp_to_epoch(ts: str) -> int:
+    if 20 != len(ts) or '-' != ts[4] or '-' != ts[7] or 'T' != ts[10] or \
+            ':' != ts[13] or ':' != ts[16] or 'Z' != ts[19]:
+        raise ValueError(f'timestamp {ts!r} is not in {TIMESTAMP_FORMAT}')
+    # only ASCII digits in the fields (int() also takes signs, spaces and
+    # other digits, strptime doesn't)
+    digits = ts[0:4] + ts[5:7] + ts[8:10] + ts[11:13] + ts[14:16] + ts[17:19]
+    if 0 < len(digits.strip('0123456789')):
+        raise ValueError(f'timestamp {ts!r} is not in {TIMESTAMP_FORMAT}')
+    year = int(ts[0:4])
+    month = int(ts[5:7])
+    day = int(ts[8:10])
+    hour = int(ts[11:13])
+    minute = int(ts[14:16])
+    second = int(ts[17:19])
+    if not (1 <= month <= 12 and 1 <= day <= 28 + __month_extra_days(year,
+            month) and hour < 24 and minute < 60 and second < 62):
+        raise ValueError(f'timestamp {ts!r} is out of range')
+
+    # days since 1970-01-01 of the proleptic Gregorian date
+    # (from Howard Hinnant's days_from_civil algorithm)
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+
+#------------------------------------------------------------------------------
+# Private: returns the days a month has over 28.
+def __month_extra_days(year: int, month: int) -> int:
+    if 2 == month:
+        return int(0 == year % 4 and (0 != year % 100 or 0 == year % 400))
+    return 2 if month in (4, 6, 9, 11) else 3
+
+
+#------------------------------------------------------------------------------
+# Returns the whole minutes since epoch seconds (can be negative).
+def minutes_since_epoch(epoch: int) -> int:
+    return int((time.time() - epoch) / 60.0)
+
+
+#------------------------------------------------------------------------------
+# Import a module lazily: it is only really loaded (executed) the first time
+# one of its attributes is used.  For our big client libraries, which take
+# seconds to import, so that importing our modules is cheap.
+#   e.g.  pubsub = utils.lazy_import('google.cloud.pubsub')
+# Note: don't use the module's attributes at import time (e.g. as default
+# args or in module level statements), or that loads it right away.
+# Raises ImportError if the module (or, for a submodule of a package that 
+# isn't imported yet, the package) isn't installed.
+def lazy_import(name: str) -> Any:
+    module = sys.modules.get(name)
+    if module is not None:
+        return module # already imported
+    # Finding a submodule would import its package, so only look for that.
+    top_name = name.partition('.')[0]
+    find_name = name if top_name in sys.modules else top_name
+    if importlib.util.find_spec(find_name) is None:
+        raise ImportError(f'No module named {find_name!r}', name=find_name)
+    return LazyModule(name)
+
+
+class LazyModule(types.ModuleType):
+    """ Stands in for a module until one of its attributes is used, then the
+        module is imported and the attribute is got from it.
+        Safe to first use from many threads: they all wait in the import 
+        system (on the module's import lock) until it is fully loaded.
+    """
+
+    #--------------------------------------------------------------------------
+    # Only called for attributes we don't have, which is all of them.
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(importlib.import_module(self.__name__), attr)
+
 
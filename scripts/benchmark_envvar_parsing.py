@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+""" Measure the time to get the name and value out of EnvVar 'values' strings.
+    - 'old' is the original code: ast.literal_eval() of the string once for
+      the name and once for the value (and string scanning if that fails).
+    - 'new' is cc.mqtt.env_var_parser.parse_values(), one pass.
+    - The payloads are like those our brains send, both parsers must get the
+      same (str) name and value from each, or this exits with an error.
+
+    Usage: python3 scripts/benchmark_envvar_parsing.py [--runs N]
+"""
+
+import argparse, ast, os, sys, tempfile, timeit
+
+# Captured 'values' strings of EnvVar and CommandReply messages.
+PAYLOADS = [
+    "{'values':[{'name':'air_temperature_celcius', 'type':'float', 'value':22.5}]}",
+    "{'values':[{'name':'air_humidity_percent', 'type':'float', 'value':45.83}]}",
+    "{'values':[{'name':'air_carbon_dioxide_ppm', 'type':'float', 'value':412}]}",
+    "{'values':[{'name':'water_potential_hydrogen', 'type':'float', 'value':6.1}]}",
+    "{'values':[{'name':'water_electrical_conductivity_ms_cm', 'type':'float', 'value':1.92}]}",
+    "{'values':[{'name':'water_temperature_celcius', 'type':'float', 'value':20.25}]}",
+    "{'values':[{'name':'light_intensity_watts', 'type':'float', 'value':None}]}",
+    "{'values':[{'name':'light_illumination_distance_cm', 'type':'float', 'value':-0.5}]}",
+    "{'values':[{'name':'status', 'type':'str', 'value':'OK'}]}",
+    "{'values':[{'name':'boot', 'type':'str', 'value':'{\"remote_URL\": \"http://10.0.0.12:5000\", \"access_point\": \"BeagleBone-4B1A\"}'}]}",
+    "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}",
+    "{'values':[{'name':'light_spectrum_nm_percent', 'type':'dict', 'value':{'380-399': 2.03, '400-499': 20.3, '500-599': 23.27, '600-700': 31.09, '701-780': 23.31}}]}",
+    "{'values':[{'name':'recipe_start', 'type':'str', 'value':'Get Growing - Basil Recipe'}]}",
+    "{'values':[{'name':'upgrade', 'type':'str', 'value':'True'}]}",
+    "{'values':[{'name':'reset', 'type':'bool', 'value':True}]}",
+    "{'values':[{'name':'URL', 'type':'str', 'value':'https://storage.googleapis.com/openag-v1-images/EDU-4B1A_Camera-Top_2019-06-01T12:00:00Z.png'}]}",
+]
+
+
+#------------------------------------------------------------------------------
+# The original MQTTMessaging.__string_to_value()
+def old_string_to_value(string):
+    try:
+        values = ast.literal_eval( string ) # if this works, great!
+        firstVal = values['values'][0]
+        return firstVal['value']
+    except:
+        valueTag = "\'value\':\'"
+        endTag = "}]}"
+        valueStart = string.find( valueTag )
+        valueEnd = string.find( endTag )
+        if -1 == valueStart or -1 == valueEnd:
+            return string
+        valueStart += len( valueTag )
+        valueEnd -= 1
+        val = string[ valueStart:valueEnd ]
+        return ast.literal_eval(val) # let exceptions from this flow up
+    return string
+
+
+#------------------------------------------------------------------------------
+# The original MQTTMessaging.__string_to_name()
+def old_string_to_name(string):
+    try:
+        values = ast.literal_eval( string ) # if this works, great!
+        firstVal = values['values'][0]
+        return firstVal['name']
+    except:
+        nameTag = "\'name\':\'"
+        endTag = "\'"
+        nameStart = string.find( nameTag )
+        if -1 == nameStart:
+            return None
+        nameStart += len( nameTag )
+        nameEnd = string.find( endTag, nameStart )
+        if -1 == nameEnd:
+            return None
+        name = string[ nameStart:nameEnd ]
+        return name
+    return ''
+
+
+#------------------------------------------------------------------------------
+def old_parse(string):
+    return old_string_to_name(string), old_string_to_value(string)
+
+
+#------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=2000,
+            help='times each payload is parsed')
+    args = parser.parse_args()
+
+    # Our modules import each other as cloud_common.cc..., so make sure the
+    # repo can be imported with that name (it usually is a submodule dir).
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tmp = tempfile.TemporaryDirectory()
+    if 'cloud_common' == os.path.basename(repo):
+        sys.path.insert(0, os.path.dirname(repo))
+    else:
+        os.symlink(repo, os.path.join(tmp.name, 'cloud_common'))
+        sys.path.insert(0, tmp.name)
+    from cloud_common.cc.mqtt.env_var_parser import parse_values
+
+    def new_parse(string):
+        name, _, value = parse_values(string)
+        return name, value
+
+    # Both must save the same strings.
+    for payload in PAYLOADS:
+        old = [str(v) for v in old_parse(payload)]
+        new = [str(v) for v in new_parse(payload)]
+        if old != new:
+            print(f'mismatch for {payload}\n  old={old}\n  new={new}')
+            sys.exit(1)
+
+    print(f'{"parser":<8} {"usecs/payload":>14}')
+    times = {}
+    for name, func in (('old', old_parse), ('new', new_parse)):
+        secs = min(timeit.repeat(lambda: [func(p) for p in PAYLOADS],
+            number=args.runs // 10 or 1, repeat=10))
+        times[name] = secs / ((args.runs // 10 or 1) * len(PAYLOADS)) * 1e6
+        print(f'{name:<8} {times[name]:>14.2f}')
+    print(f'speedup  {times["old"] / times["new"]:>14.1f}x')
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
+
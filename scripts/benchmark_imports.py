@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+""" Measure the cold import time of each of our modules.
+    - Each module is imported in a new python process (so nothing is already
+      imported or cached), a few times, and the best time is reported.
+    - Our modules should import quickly, the big google client libraries
+      are only loaded when they are first used.
+
+    Usage: python3 scripts/benchmark_imports.py [--runs N] [module ...]
+      e.g. python3 scripts/benchmark_imports.py cc.google.pubsub
+"""
+
+import argparse, os, subprocess, sys, tempfile
+
+MODULES = [
+    'cc.utils',
+    'cc.cache',
+    'cc.parallel',
+    'cc.google.env_vars',
+    'cc.google.clients',
+    'cc.google.retry',
+    'cc.google.device_data_codec',
+    'cc.google.datastore',
+    'cc.google.device_data_writer',
+    'cc.google.database',
+    'cc.google.storage',
+    'cc.google.storage_janitor',
+    'cc.google.bigquery',
+    'cc.google.bigquery_row_buffer',
+    'cc.google.iot',
+    'cc.google.firebase',
+    'cc.google.pubsub',
+    'cc.google.auth',
+    'cc.mqtt.deprecated_image_chunking',
+    'cc.mqtt.env_var_parser',
+    'cc.mqtt.image_upload_finalizer',
+    'cc.mqtt.mqtt_messaging',
+]
+
+# Run in the child process, prints the import time in seconds.
+TIMER = '''
+import time
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+'''
+
+
+#------------------------------------------------------------------------------
+# Returns the best import time (secs) of a module, or an error string.
+def time_import(module, path, runs):
+    best = None
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-c', TIMER.format(module)],
+                cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+        if 0 != proc.returncode:
+            lines = proc.stderr.strip().splitlines()
+            return lines[-1] if lines else f'exit {proc.returncode}'
+        secs = float(proc.stdout.strip().splitlines()[-1])
+        if best is None or secs < best:
+            best = secs
+    return best
+
+
+#------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3,
+            help='imports of each module, the best time is shown')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+            help='modules (relative to the cloud_common package) to time')
+    args = parser.parse_args()
+
+    # Our modules import each other as cloud_common.cc..., so make sure the
+    # repo can be imported with that name (it usually is a submodule dir).
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'cloud_common' == os.path.basename(repo):
+            path = os.path.dirname(repo)
+        else:
+            os.symlink(repo, os.path.join(tmp, 'cloud_common'))
+            path = tmp
+
+        total = 0.0
+        print(f'{"module":<40} {"import secs":>12}')
+        for module in args.modules:
+            res = time_import(f'cloud_common.{module}', path, args.runs)
+            if isinstance(res, float):
+                total += res
+                print(f'{module:<40} {res:>12.4f}')
+            else:
+                print(f'{module:<40} {"error":>12}  {res}')
+        print(f'{"total":<40} {total:>12.4f}')
+
+
+if __name__ == '__main__':
+    main()
+